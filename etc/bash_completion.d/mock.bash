@@ -86,12 +86,13 @@ _mock()
 
     if [[ "$cur" == -* ]] ; then
         COMPREPLY=( $( compgen -W "--version --help --rebuild --buildsrpm
-            --shell --chroot --clean --scrub --init --installdeps --install
-            --update --remove --orphanskill --copyin --copyout --root --offline
+            --shell --chroot --clean --scrub --init --refresh-root-cache
+            --prune-yum-cache --installdeps --install --update --remove
+            --orphanskill --copyin --copyout --batch --root --offline
             --no-clean --cleanup-after --no-cleanup-after --arch --target
             --define --with --without --resultdir --uniqueext --configdir
-            --rpmbuild_timeout --unpriv --cwd --spec --sources --verbose
-            --quiet --trace --enable-plugin --disable-plugin
+            --rpmbuild_timeout --pool --unpriv --cwd --spec --sources --verbose
+            --quiet --trace --profile --enable-plugin --disable-plugin
             --print-root-path --scm-enable --scm-option" -- "$cur" ) )
         return 0
     fi
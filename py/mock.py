@@ -29,6 +29,7 @@
            mock [options] --copyin path [..path] destination
            mock [options] --copyout path [..path] destination
            mock [options] --scm-enable [--scm-option key=value]
+           mock [options] --batch < lines of "SRPM<tab>RESULTDIR[<tab>TIMEOUT]"
 """
 
 # library imports
@@ -62,8 +63,15 @@ log = logging.getLogger()
 
 # our imports
 import mockbuild.exception
+import mockbuild.trace_decorator
+# functions are only wrapped for --trace (or an abbreviation optparse takes
+# for it) when their modules are imported, which is before it is parsed
+mockbuild.trace_decorator.tracing = bool([arg for arg in sys.argv[1:]
+                                          if len(arg) > 3 and "--trace".startswith(arg)])
 from mockbuild.trace_decorator import traceLog, decorate
 import mockbuild.backend
+import mockbuild.pool
+import mockbuild.profiler
 import mockbuild.uid
 import mockbuild.util
 
@@ -100,6 +108,14 @@ def command_parse(config_opts):
                       help="completely remove the specified chroot or cache dir or all of the chroot and cache")
     parser.add_option("--init", action="store_const", const="init", dest="mode",
                       help="initialize the chroot, do not build anything")
+    parser.add_option("--refresh-root-cache", action="store_const",
+                      const="refresh-root-cache", dest="mode",
+                      help="update the packages of the root cache, in a chroot"
+                           " of its own, and store it again")
+    parser.add_option("--prune-yum-cache", action="store_const",
+                      const="prune-yum-cache", dest="mode",
+                      help="remove the files of the yum cache that are older"
+                           " than the yum_cache plugin keeps them")
     parser.add_option("--installdeps", action="store_const", const="installdeps",
                       dest="mode",
                       help="install build dependencies for a specified SRPM")
@@ -124,6 +140,12 @@ def command_parse(config_opts):
                       dest="mode",
                       help="Copy file(s) from the specified chroot")
 
+    parser.add_option("--batch", action="store_const", const="batch",
+                      dest="mode",
+                      help="rebuild the SRPMs read from stdin, one 'SRPM<tab>RESULTDIR'"
+                           " (optionally '<tab>TIMEOUT') line each, reusing this mock"
+                           " process for all of them")
+
     # options
     parser.add_option("-r", "--root", action="store", type="string", dest="chroot",
                       help="chroot name/config file name default: %default",
@@ -168,6 +190,10 @@ def command_parse(config_opts):
                       default=None,
                       help="Arbitrary, unique extension to append to buildroot"
                            " directory name")
+    parser.add_option("--pool", action="store", type="int", dest="pool",
+                      default=None, metavar="N",
+                      help="build in one of N buildroots kept initialized"
+                           " for this config. Only for 'rebuild'.")
     parser.add_option("--configdir", action="store", dest="configdir",
                       default=None,
                       help="Change where config files are found")
@@ -195,6 +221,9 @@ def command_parse(config_opts):
                       dest="verbose", help="quiet build")
     parser.add_option("--trace", action="store_true", default=False,
                       dest="trace", help="Enable internal mock tracing output.")
+    parser.add_option("--profile", action="store_true", default=False,
+                      help="Record the time spent in each state and plugin hook"
+                           " to profile.json and profile.folded in the resultdir.")
 
     # plugins
     parser.add_option("--enable-plugin", action="append",
@@ -235,6 +264,14 @@ def command_parse(config_opts):
         if options.rpmbuild_arch.find(',') != -1:
                    raise mockbuild.exception.BadCmdline, "--target option accepts only one arch. Invalid: %s" % options.rpmbuild_arch
 
+    if options.pool is not None:
+        if options.pool < 1:
+            raise mockbuild.exception.BadCmdline, "--pool needs at least 1 buildroot"
+        if options.uniqueext:
+            raise mockbuild.exception.BadCmdline, "--pool and --uniqueext cannot be used together"
+        if options.mode != 'rebuild':
+            raise mockbuild.exception.BadCmdline, "--pool can only be used to rebuild SRPMs"
+
     if options.mode == 'buildsrpm' and not (options.spec and options.sources):
         if not options.scm:
             raise mockbuild.exception.BadCmdline, "Must specify both --spec and --sources with --buildsrpm"
@@ -304,6 +341,54 @@ def do_rebuild(config_opts, chroot, srpms):
             chroot.clean()
         raise
 
+decorate(traceLog())
+def do_batch(config_opts, chroot, infile, outfile):
+    """rebuild srpms as they are read from infile, each into its own
+       resultdir. The configs, plugins and chroot object are set up only
+       once for all of them; the chroot itself is still cleaned and
+       reinitialized (from the root cache) for each srpm. A status line is
+       written to outfile after each one. A line may have a third field,
+       the rpmbuild timeout for that srpm."""
+    depth = len(chroot._state)
+    default_timeout = config_opts['rpmbuild_timeout']
+    while True:
+        line = infile.readline()
+        if not line:
+            break
+        line = line.rstrip("\n")
+        if not line:
+            continue
+        fields = line.split("\t")
+        timeout = default_timeout
+        try:
+            srpm, resultdir = fields[:2]
+            if len(fields) == 3:
+                timeout = int(fields[2])
+            elif len(fields) != 2:
+                raise ValueError
+        except ValueError:
+            log.error("Bad batch line, want 'SRPM<tab>RESULTDIR[<tab>TIMEOUT]': %s" % line)
+            outfile.write("mock-batch: 50 %s\n" % line)
+            outfile.flush()
+            continue
+
+        chroot.setResultDir(resultdir)
+        config_opts['rpmbuild_timeout'] = timeout
+        try:
+            do_rebuild(config_opts, chroot, [srpm])
+            status = 0
+        except (mockbuild.exception.Error,), exc:
+            log.error(str(exc))
+            status = exc.resultcode
+        except (Exception,), exc:
+            log.exception(exc)
+            status = 1
+        # a failed build leaves its states behind
+        while len(chroot._state) > depth:
+            chroot.finish(chroot.state())
+        outfile.write("mock-batch: %d %s\n" % (status, srpm))
+        outfile.flush()
+
 def do_buildsrpm(config_opts, chroot, options, args):
     # verify the input command line arguments actually exist
     if not os.path.isfile(options.spec):
@@ -514,9 +599,30 @@ def main(ret):
     # elevate privs
     uidManager._becomeUser(0, 0)
 
+    if options.mode == 'prune-yum-cache':
+        if not config_opts['plugin_conf']['yum_cache_enable']:
+            raise mockbuild.exception.BadCmdline, "--prune-yum-cache needs the yum_cache plugin enabled"
+
+    if options.mode == 'refresh-root-cache':
+        if not config_opts['plugin_conf']['root_cache_enable']:
+            raise mockbuild.exception.BadCmdline, "--refresh-root-cache needs the root_cache plugin enabled"
+        # leave the chroot used for builds alone
+        if not config_opts.has_key('unique-ext'):
+            config_opts['unique-ext'] = 'refresh-root-cache'
+
+    # pick a buildroot of the pool; a ready one needs no clean
+    pool = None
+    if options.pool:
+        pool = mockbuild.pool.ChrootPool(config_opts, options.pool)
+        config_opts['unique-ext'] = pool.claim()
+        if pool.isReady():
+            config_opts['clean'] = False
+
     # do whatever we're here to do
     log.info("mock.py version %s starting..." % __VERSION__)
     chroot = mockbuild.backend.Root(config_opts, uidManager)
+    if options.profile:
+        chroot.profiler = mockbuild.profiler.Profiler()
 
     chroot.start("run")
 
@@ -556,6 +662,15 @@ def main(ret):
             chroot.clean()
         chroot.init()
 
+    elif options.mode == 'refresh-root-cache':
+        chroot.refreshRootCache = True
+        chroot.clean()
+        chroot.init()
+        chroot.clean()
+
+    elif options.mode == 'prune-yum-cache':
+        chroot.yum_cacheObj.prune()
+
     elif options.mode == 'clean':
         if len(options.scrub) == 0:
             chroot.clean()
@@ -633,6 +748,9 @@ def main(ret):
     elif options.mode == 'buildsrpm':
         do_buildsrpm(config_opts, chroot, options, args)
 
+    elif options.mode == 'batch':
+        do_batch(config_opts, chroot, sys.stdin, sys.stdout)
+
     elif options.mode == 'orphanskill':
         mockbuild.util.orphansKill(chroot.makeChrootPath())
     elif options.mode == 'copyin':
@@ -682,6 +800,10 @@ def main(ret):
     chroot.finish("run")
     chroot.alldone()
 
+    if pool:
+        # whatever runs in the buildroot now belongs to the refresh
+        ret["pool_refresh"] = pool.refresh(chroot)
+
 if __name__ == '__main__':
     # fix for python 2.4 logging module bug:
     logging.raiseExceptions = 0
@@ -732,7 +854,11 @@ if __name__ == '__main__':
         exitStatus = 1
         log.exception(exc)
 
-    if killOrphans and retParams:
+    # also for a failed run, it shows how far it got
+    if retParams.get("chroot") is not None:
+        retParams["chroot"].writeProfile()
+
+    if killOrphans and retParams and not retParams.get("pool_refresh"):
         mockbuild.util.orphansKill(retParams["chroot"].makeChrootPath())
 
     logging.shutdown()
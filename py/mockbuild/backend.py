@@ -38,8 +38,29 @@ class Root(object):
         self._hooks = {}
         self.chrootWasCached = False
         self.chrootWasCleaned = False
+        # set by a plugin when the chroot came from a cache recent enough
+        # that the yum update in init is not worth doing
+        self.skipYumUpdate = False
+        # set for mock --refresh-root-cache: update the cached chroot and
+        # store it in the cache again
+        self.refreshRootCache = False
+        # set by a plugin in the prebuild hook when it has put the rpms of
+        # this build in the resultdir already, so rpmbuild -bb is skipped
+        self.buildWasCached = False
+        # the srpm being built, and the rpms it gave when it built fine
+        self.buildSrpm = None
+        self.buildCheck = True
+        self.builtPackages = []
         self.preExistingDeps = []
+        # what installSrpmDeps is about to install, for the preinstalldeps
+        # and postinstalldeps hooks
+        self.buildDeps = []
+        # the yum command line being run, for the preyum and postyum hooks
+        self.yumCommand = None
+        # a mockbuild.profiler.Profiler for mock --profile
+        self.profiler = None
         self.logging_initialized = False
+        self._logHandlers = []
         self.buildrootLock = None
         self.version = config['version']
 
@@ -48,6 +69,7 @@ class Root(object):
             config['root'] = "%s-%s" % (config['root'], config['unique-ext'])
 
         self.basedir = os.path.join(config['basedir'], config['root'])
+        self.target_arch = config['target_arch']
         self.rpmbuild_arch = config['rpmbuild_arch']
         self._rootdir = os.path.join(self.basedir, 'root')
         self.homedir = config['chroothome']
@@ -101,6 +123,7 @@ class Root(object):
         self.cache_alterations = config['cache_alterations']
         self.useradd = config['useradd']
         self.online = config['online']
+        self.output_memory_limit = config['output_memory_limit']
         self.internal_dev_setup = config['internal_dev_setup']
 
         self.backup = config['backup_on_clean']
@@ -159,6 +182,8 @@ class Root(object):
         if state == None:
             raise mockbuild.exception.StateError, "start called with None State"
         self._state.append(state)
+        if self.profiler is not None:
+            self.profiler.push(state)
         self._state_log.info("Start: %s" % state)
 
     def finish(self, state):
@@ -167,6 +192,10 @@ class Root(object):
         current = self._state.pop()
         if state != current:
             raise mockbuild.exception.StateError, "state finish mismatch: current: %s, state: %s" % (current, state)
+        mockbuild.util.flushLogs(self.root_log)
+        mockbuild.util.flushLogs(self.build_log)
+        if self.profiler is not None:
+            self.profiler.pop()
         self._state_log.info("Finish: %s" % state)
 
     def alldone(self):
@@ -340,7 +369,9 @@ class Root(object):
         self.root_log.debug('rootdir = %s' % self.makeChrootPath())
         self.root_log.debug('resultdir = %s' % self.resultdir)
 
-        # set up plugins:
+        # set up plugins: they decide again for every init whether the
+        # yum update may be skipped (the Root lives on with --batch)
+        self.skipYumUpdate = False
         getLog().info("calling preinit hooks")
         self._callHooks('preinit')
 
@@ -431,8 +462,8 @@ class Root(object):
             self._mountall()
             if self.chrootWasCleaned:
                 self.yum_init_install_output = self._yum(self.chroot_setup_cmd, returnOutput=1)
-            if self.chrootWasCached:
-                self._yum(('update',), returnOutput=1)
+            if self.chrootWasCached and not self.skipYumUpdate:
+                self._yum(('update',))
 
             self.finish("yum update")
             # create user
@@ -566,6 +597,7 @@ class Root(object):
         """execute given command in root"""
         if not mockbuild.util.hostIsEL5():
             self._nuke_rpm_db()
+        kargs.setdefault('maxMemory', self.output_memory_limit)
         return mockbuild.util.do(command, chrootPath=self.makeChrootPath(),
                                  env=self.env, raiseExc=raiseExc,
                                  returnOutput=returnOutput, shell=shell,
@@ -574,6 +606,7 @@ class Root(object):
     def doNonChroot(self, command, shell=True, returnOutput=False, printOutput=False, raiseExc=True, *args, **kargs):
         '''run a command *without* chrooting'''
         self._nuke_rpm_db()
+        kargs.setdefault('maxMemory', self.output_memory_limit)
         return mockbuild.util.do(command, env=self.env, raiseExc=raiseExc,
                                  returnOutput=returnOutput, shell=shell,
                                  printOutput=printOutput, *args, **kargs)
@@ -595,7 +628,7 @@ class Root(object):
         """use yum to update the chroot"""
         try:
             self._mountall()
-            self._yum(('update',), returnOutput=1)
+            self._yum(('update',))
         finally:
             self._umountall()
 
@@ -617,16 +650,27 @@ class Root(object):
             self.uidManager.becomeUser(0, 0)
 
             def _yum_and_check(cmd):
-                output = self._yum(cmd, returnOutput=1)
-                for line in output.split('\n'):
+                # look at the lines as yum prints them, all of it is in
+                # root.log anyway
+                bad = []
+                def check(line):
+                    if bad:
+                        return
                     if line.lower().find('No Package found for'.lower()) != -1 or line.lower().find('Missing Dependency'.lower()) != -1:
-                        raise mockbuild.exception.BuildError, "Bad build req: %s. Exiting." % line
+                        bad.append(line)
+                self._yum(cmd, lineCallback=check)
+                if bad:
+                    raise mockbuild.exception.BuildError, "Bad build req: %s. Exiting." % bad[0]
 
             # first, install pre-existing deps and configured additional ones
             deps = list(self.preExistingDeps)
+            buildreqs = []
             for hdr in mockbuild.util.yieldSrpmHeaders(srpms, plainRpmOk=1):
                 # get text buildreqs
                 deps.extend(mockbuild.util.getAddtlReqs(hdr, self.more_buildreqs))
+                buildreqs.extend(mockbuild.util.getBuildReqs(hdr))
+            self.buildDeps = deps + buildreqs
+            self._callHooks('preinstalldeps')
             if deps:
                 # everything exists, okay, install them all.
                 # pass build reqs to installer
@@ -634,10 +678,11 @@ class Root(object):
                 _yum_and_check(args)
                 # nothing made us exit, so we continue
                 args[0] = 'install'
-                self._yum(args, returnOutput=1)
+                self._yum(args)
 
             # install actual build dependencies
             _yum_and_check(['builddep'] + list(srpms))
+            self._callHooks('postinstalldeps')
         finally:
             self.uidManager.restorePrivs()
 
@@ -662,6 +707,11 @@ class Root(object):
     def build(self, srpm, timeout, check=True):
         """build an srpm into binary rpms, capture log"""
 
+        self.buildSrpm = srpm
+        self.buildCheck = check
+        self.buildWasCached = False
+        self.builtPackages = []
+
         # tell caching we are building
         self._callHooks('earlyprebuild')
 
@@ -725,28 +775,33 @@ class Root(object):
             # tell caching we are building
             self._callHooks('prebuild')
 
-            check_opt = ''
-            if not check:
-                check_opt = '--nocheck'
+            if self.buildWasCached:
+                self.root_log.info("rpmbuild -bb skipped, the results were cached")
+            else:
+                check_opt = ''
+                if not check:
+                    check_opt = '--nocheck'
 
-            # --nodeps because rpm in the root may not be able to read rpmdb
-            # created by rpm that created it (outside of chroot)
-            self.doChroot(
-                ["bash", "--login", "-c", 'rpmbuild -bb --target %s --nodeps %s %s' % (self.rpmbuild_arch, check_opt, chrootspec)],
-                shell=False,
-                logger=self.build_log, timeout=timeout,
-                uid=self.chrootuid,
-                gid=self.chrootgid,
-                )
+                # --nodeps because rpm in the root may not be able to read rpmdb
+                # created by rpm that created it (outside of chroot)
+                self.doChroot(
+                    ["bash", "--login", "-c", 'rpmbuild -bb --target %s --nodeps %s %s' % (self.rpmbuild_arch, check_opt, chrootspec)],
+                    shell=False,
+                    logger=self.build_log, timeout=timeout,
+                    uid=self.chrootuid,
+                    gid=self.chrootgid,
+                    )
 
-            bd_out = self.makeChrootPath(self.builddir)
-            rpms = glob.glob(bd_out + '/RPMS/*.rpm')
-            srpms = glob.glob(bd_out + '/SRPMS/*.rpm')
-            packages = rpms + srpms
+                bd_out = self.makeChrootPath(self.builddir)
+                rpms = glob.glob(bd_out + '/RPMS/*.rpm')
+                srpms = glob.glob(bd_out + '/SRPMS/*.rpm')
+                packages = rpms + srpms
 
-            self.root_log.debug("Copying packages to result dir")
-            for item in packages:
-                shutil.copy2(item, self.resultdir)
+                self.root_log.debug("Copying packages to result dir")
+                for item in packages:
+                    shutil.copy2(item, self.resultdir)
+                self.builtPackages = [os.path.join(self.resultdir, os.path.basename(item))
+                                      for item in packages]
 
             self.finish(rpmbuildstate)
 
@@ -901,7 +956,27 @@ class Root(object):
     def _callHooks(self, stage):
         hooks = self._hooks.get(stage, [])
         for hook in hooks:
-            hook()
+            if self.profiler is None:
+                hook()
+                continue
+            name = hook.__name__
+            if getattr(hook, "im_self", None) is not None:
+                name = "%s.%s" % (hook.im_self.__class__.__name__, name)
+            self.profiler.call("%s %s" % (stage, name), hook)
+
+    decorate(traceLog())
+    def writeProfile(self):
+        """save what the profiler recorded in the resultdir"""
+        if self.profiler is None:
+            return
+        self.uidManager.dropPrivsTemp()
+        try:
+            try:
+                self.profiler.write(self.resultdir)
+            except (IOError, OSError), e:
+                getLog().warning("could not write the profile: %s" % e)
+        finally:
+            self.uidManager.restorePrivs()
 
     decorate(traceLog())
     def _initPlugins(self):
@@ -953,8 +1028,27 @@ class Root(object):
         return out
 
     decorate(traceLog())
-    def _yum(self, cmd, returnOutput=0):
-        """use yum to install packages/package groups into the chroot"""
+    def _yum(self, cmd, returnOutput=0, cacheOnly=False, lineCallback=None):
+        """use yum to install packages/package groups into the chroot,
+           lineCallback is called with each line yum prints"""
+
+        if cmd[0] == 'resolvedep' and self.online and not cacheOnly:
+            # resolving deps only reads the repo metadata. Try with what is
+            # cached first: a yum that does not write to the yum cache does
+            # not need it to itself (see the yum_cache plugin). What is
+            # not found there may be new in the repos.
+            # resolvedep prints a line per dep, those are kept to be given
+            # to lineCallback once it is clear they are the answer
+            lines = []
+            try:
+                output = self._yum(cmd, returnOutput=returnOutput, cacheOnly=True, lineCallback=lines.append)
+                if not [line for line in lines if line.lower().find('no package found') != -1]:
+                    if lineCallback is not None:
+                        for line in lines:
+                            lineCallback(line)
+                    return output
+            except mockbuild.exception.YumError:
+                pass
 
         yumcmd = [self.yum_path]
         cmdix = 0
@@ -966,16 +1060,18 @@ class Root(object):
                 for eachopt in self.yum_builddep_opts.split():
                     yumcmd.insert(1, '%s' % eachopt)
         yumcmd.extend(('--installroot', self.makeChrootPath()))
-        if not self.online:
+        if not self.online or cacheOnly:
             yumcmd.append("-C")
         yumcmd.extend(self.yum_common_opts)
         yumcmd.extend(cmd[cmdix:])
         self.root_log.debug(yumcmd)
         output = ""
         self._nuke_rpm_db()
+        self.yumCommand = yumcmd
         try:
             self._callHooks("preyum")
-            output = mockbuild.util.do(yumcmd, returnOutput=returnOutput, env=self.env)
+            output = mockbuild.util.do(yumcmd, returnOutput=returnOutput, env=self.env,
+                                       lineCallback=lineCallback, maxMemory=self.output_memory_limit)
             self._callHooks("postyum")
             return output
         except mockbuild.exception.Error, e:
@@ -1036,16 +1132,32 @@ class Root(object):
                     (self.build_log, "build.log", self.build_log_fmt_str),
                     (self.root_log, "root.log", self.root_log_fmt_str)):
                 fullPath = os.path.join(self.resultdir, filename)
-                fh = logging.FileHandler(fullPath, "a+")
+                if log is self._state_log:
+                    fh = logging.FileHandler(fullPath, "a+")
+                else:
+                    # these get all the output of yum and rpmbuild
+                    fh = mockbuild.util.BufferedFileHandler(fullPath, "a+")
                 formatter = logging.Formatter(fmt_str)
                 fh.setFormatter(formatter)
                 fh.setLevel(logging.NOTSET)
                 log.addHandler(fh)
+                self._logHandlers.append((log, fh))
                 log.info("Mock Version: %s" % self.version)
         finally:
             self.uidManager.restorePrivs()
 
 
+    decorate(traceLog())
+    def setResultDir(self, resultdir):
+        """send results and logs to another dir, the log files there are
+           attached the next time they are needed"""
+        for (log, fh) in self._logHandlers:
+            log.removeHandler(fh)
+            fh.close()
+        self._logHandlers = []
+        self.logging_initialized = False
+        self.resultdir = resultdir
+
     #
     # UNPRIVILEGED:
     #   Everything in this function runs as the build user
@@ -119,8 +119,13 @@ class Mounts(object):
         self.mounts.append(FileSystemMountPoint(filetype='devpts', device='mock_chroot_devpts', path=rootObj.makeChrootPath('/dev/pts'), options=opts))
 
     decorate(traceLog())
-    def add(self, mount):
-        self.mounts.append(mount)
+    def add(self, mount, first=False):
+        """first is for a mount the others go on top of, it is mounted
+           before and unmounted after all of them"""
+        if first:
+            self.mounts.insert(0, mount)
+        else:
+            self.mounts.append(mount)
 
     decorate(traceLog())
     def mountall(self):
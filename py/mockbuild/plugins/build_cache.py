@@ -0,0 +1,128 @@
+# vim:expandtab:autoindent:tabstop=4:shiftwidth=4:filetype=python:textwidth=0:
+# License: GPL2 or later see COPYING
+# Copyright (C) 2013 Red Hat, Inc
+
+# this plugin keeps the rpms of every successful build, keyed by everything
+# that went into it:
+#   - the checksum of the srpm
+#   - the rpm macros (including the ones from --with/--without/--define)
+#   - the target arch and whether %check is run
+#   - the NEVRAs of all the pkgs installed in the buildroot
+# when a later build of the same srpm comes out with the same key once its
+# build deps are installed, rpmbuild -bb is skipped and the cached rpms are
+# put in the resultdir instead (hardlinked when possible)
+
+# python library imports
+import hashlib
+import os
+import shutil
+
+# our imports
+from mockbuild.trace_decorator import decorate, traceLog, getLog
+import mockbuild.util
+
+requires_api_version = "1.0"
+
+# plugin entry point
+decorate(traceLog())
+def init(rootObj, conf):
+    BuildCache(rootObj, conf)
+
+# classes
+class BuildCache(object):
+    """skips rpmbuild when the same build was done before"""
+    decorate(traceLog())
+    def __init__(self, rootObj, conf):
+        self.rootObj = rootObj
+        self.build_cache_opts = conf
+        self.buildCachePath = self.build_cache_opts['dir'] % self.build_cache_opts
+        self.cacheKey = None
+        rootObj.buildCacheObj = self
+        rootObj.addHook("preinit", self._buildCachePreInitHook)
+        rootObj.addHook("prebuild", self._buildCachePreBuildHook)
+        rootObj.addHook("postbuild", self._buildCachePostBuildHook)
+
+    # =============
+    # 'Private' API
+    # =============
+    decorate(traceLog())
+    def _buildCachePreInitHook(self):
+        mockbuild.util.mkdirIfAbsent(self.buildCachePath)
+        self.rootObj.uidManager.changeOwner(self.buildCachePath)
+
+    decorate(traceLog())
+    def _cacheKey(self):
+        key = hashlib.sha256()
+        srpm = open(self.rootObj.buildSrpm, 'rb')
+        try:
+            while True:
+                data = srpm.read(1024 * 1024)
+                if not data:
+                    break
+                key.update(data)
+        finally:
+            srpm.close()
+        for name in sorted(self.rootObj.macros.keys()):
+            key.update("%s %s\n" % (name, self.rootObj.macros[name]))
+        key.update("target %s check %s\n" % (self.rootObj.rpmbuild_arch, self.rootObj.buildCheck))
+        installed = self.rootObj.doNonChroot(
+            ["rpm", "--root", self.rootObj.makeChrootPath(), "-qa", "--qf", "%{NEVRA}\n"],
+            shell=False, returnOutput=1,
+            uid=self.rootObj.chrootuid, gid=self.rootObj.chrootgid)
+        key.update("\n".join(sorted(installed.split())))
+        return key.hexdigest()
+
+    decorate(traceLog())
+    def _buildCachePreBuildHook(self):
+        self.cacheKey = self._cacheKey()
+        entry = os.path.join(self.buildCachePath, self.cacheKey)
+        if not os.path.isdir(entry):
+            getLog().info("build cache: no entry %s" % self.cacheKey)
+            return
+
+        getLog().info("build cache: using entry %s" % self.cacheKey)
+        self.rootObj.uidManager.dropPrivsTemp()
+        try:
+            for name in os.listdir(entry):
+                src = os.path.join(entry, name)
+                if name == 'build.log':
+                    dst = os.path.join(self.rootObj.resultdir, 'cached-build.log')
+                else:
+                    dst = os.path.join(self.rootObj.resultdir, name)
+                if os.path.exists(dst):
+                    os.unlink(dst)
+                try:
+                    os.link(src, dst)
+                except OSError:
+                    shutil.copy2(src, dst)
+        finally:
+            self.rootObj.uidManager.restorePrivs()
+        self.rootObj.build_log.info("rpms taken from build cache entry %s, see cached-build.log" % self.cacheKey)
+        self.rootObj.buildWasCached = True
+
+    decorate(traceLog())
+    def _buildCachePostBuildHook(self):
+        # only keep what a successful rpmbuild made
+        if self.rootObj.buildWasCached or not self.rootObj.builtPackages or not self.cacheKey:
+            return
+        entry = os.path.join(self.buildCachePath, self.cacheKey)
+        if os.path.exists(entry):
+            return
+
+        self.rootObj.uidManager.dropPrivsTemp()
+        try:
+            # fill a temporary dir and rename it, so other builds see either
+            # the complete entry or none
+            tmp = "%s.tmp.%d" % (entry, os.getpid())
+            mockbuild.util.mkdirIfAbsent(tmp)
+            try:
+                for item in self.rootObj.builtPackages:
+                    shutil.copy2(item, tmp)
+                shutil.copy2(os.path.join(self.rootObj.resultdir, 'build.log'), tmp)
+                os.rename(tmp, entry)
+                getLog().info("build cache: saved entry %s" % self.cacheKey)
+            except (OSError, IOError), e:
+                getLog().warning("build cache: could not save entry %s: %s" % (self.cacheKey, e))
+                mockbuild.util.rmtree(tmp)
+        finally:
+            self.rootObj.uidManager.restorePrivs()
@@ -5,22 +5,54 @@
 
 # python library imports
 import fcntl
+import hashlib
 import os
+import re
 import time
 from glob import glob
 
 # our imports
 from mockbuild.trace_decorator import decorate, traceLog, getLog
+from mockbuild.mounts import MountPoint, FileSystemMountPoint
+import mockbuild.exception
 import mockbuild.util
 
 requires_api_version = "1.0"
 
+# what yum resolvedep prints for each dep it resolved
+resolved_re = re.compile(r'^\d+:\S+-\S+-\S+\.\S+$')
+
+# dirs with files that are changed in place rather than replaced, which a
+# chroot hardlinked to the 'reflink' cache tree gets real copies of. init
+# rewrites var/lib/dbus/machine-id.
+reflink_copyup_dirs = ["var/lib/rpm", "var/lib/yum", "var/lib/dbus", "var/log", "etc"]
+
 # plugin entry point
 decorate(traceLog())
 def init(rootObj, conf):
     RootCache(rootObj, conf)
 
 # classes
+class OverlayMountPoint(MountPoint):
+    """the root cache overlay as the first of the chroot's mounts, so
+       mounting those mounts it first. Unlike them it is left mounted by
+       umountall(): mock writes to the chroot between its commands. clean
+       unmounts it."""
+    decorate(traceLog())
+    def __init__(self, rootCache):
+        MountPoint.__init__(self, mountsource=rootCache.overlay.device,
+                            mountpath=rootCache.overlay.path)
+        self.rootCache = rootCache
+
+    decorate(traceLog())
+    def mount(self):
+        self.rootCache._overlayMountHook()
+        return True
+
+    decorate(traceLog())
+    def umount(self, force=False, nowarn=False):
+        return True
+
 class RootCache(object):
     """caches root environment in a tarball"""
     decorate(traceLog())
@@ -28,85 +60,157 @@ class RootCache(object):
         self.rootObj = rootObj
         self.root_cache_opts = conf
         self.rootSharedCachePath = self.root_cache_opts['dir'] % self.root_cache_opts
-        self.rootCacheFile = os.path.join(self.rootSharedCachePath, "cache.tar")
-        self.rootCacheLock = None
+        # caches of differently set up chroots of the same config live side
+        # by side, each named by a hash of the settings it was made with
+        self.cacheKey = self._cacheKey()
+        self.rootCacheFile = os.path.join(self.rootSharedCachePath, "cache-%s.tar" % self.cacheKey)
         self.compressProgram = self.root_cache_opts['compress_program']
+        extension = self.root_cache_opts['extension']
         if self.compressProgram == 'pigz' and not os.path.exists('/usr/bin/pigz'):
             getLog().warning("specified 'pigz' as the root cache compress program but not available; using gzip")
             self.compressProgram = 'gzip'
+        if self.compressProgram == 'zstd':
+            if os.path.exists('/usr/bin/zstd'):
+                # compress with all cpus; decompressing zstd is fast anyway
+                self.compressProgram = 'zstd -T0'
+                if extension == '.gz':
+                    extension = '.zst'
+            else:
+                getLog().warning("specified 'zstd' as the root cache compress program but not available; using gzip")
+                self.compressProgram = 'gzip'
+                if extension == '.zst':
+                    extension = '.gz'
         if self.compressProgram:
              self.compressArgs = ['--use-compress-program', self.compressProgram]
-             self.rootCacheFile = self.rootCacheFile + self.root_cache_opts['extension']
+             self.rootCacheFile = self.rootCacheFile + extension
         else:
              self.compressArgs = []
+             extension = ""
+        self.extension = extension
+        self.depsCacheFile = None
+        self.depsKey = None
         rootObj.rootCacheObj = self
-        rootObj.addHook("preinit", self._rootCachePreInitHook)
-        rootObj.addHook("preshell", self._rootCachePreShellHook)
-        rootObj.addHook("prechroot", self._rootCachePreShellHook)
-        rootObj.addHook("preyum", self._rootCachePreYumHook)
-        rootObj.addHook("postinit", self._rootCachePostInitHook)
-        rootObj.addHook("postshell", self._rootCachePostShellHook)
-        rootObj.addHook("postchroot", self._rootCachePostShellHook)
-        rootObj.addHook("postyum", self._rootCachePostShellHook)
         self.exclude_dirs = self.root_cache_opts['exclude_dirs']
         self.exclude_tar_cmds = [ "--exclude=" + dir for dir in self.exclude_dirs]
 
+        self.method = self.root_cache_opts['method']
+        if self.method == 'overlay':
+            if rootObj.pluginConf['tmpfs_enable']:
+                getLog().warning("root cache method 'overlay' does not work with the tmpfs plugin; using 'tar'")
+                self.method = 'tar'
+            elif not [l for l in open('/proc/filesystems') if l.split()[-1] == 'overlay']:
+                getLog().warning("root cache method 'overlay' needs overlayfs, which the kernel lacks; using 'tar'")
+                self.method = 'tar'
+        if self.method in ('overlay', 'reflink'):
+            # the cached chroot is kept as a plain directory tree, never
+            # written to once complete. Updating the cache makes a new tree
+            # (a generation) and points the symlink treeLink at it.
+            self.treeDir = None
+            self.treeLock = None
+        if self.method == 'overlay':
+            # each chroot mounts an overlay of the tree with an upper dir of
+            # its own, which clean() removes. chroots keep using the
+            # generation they were made from, which is recorded in
+            # overlay/lower next to their upper dir.
+            self.treeLink = os.path.join(self.rootSharedCachePath, "overlay-lower-%s" % self.cacheKey)
+            self.treeRecord = os.path.join(rootObj.basedir, "overlay", "lower")
+            self.upperDir = os.path.join(rootObj.basedir, "overlay", "upper")
+            self.workDir = os.path.join(rootObj.basedir, "overlay", "work")
+            self.overlay = FileSystemMountPoint(filetype='overlay',
+                    device='mock_chroot_overlay', path=rootObj.makeChrootPath())
+            # the overlay has to be there before anything is mounted in the
+            # chroot, and whenever something in it is used
+            rootObj.mounts.add(OverlayMountPoint(self), first=True)
+            rootObj.addHook("preinit", self._overlayPreInitHook)
+            rootObj.addHook("preshell", self._overlayMountHook)
+            rootObj.addHook("prechroot", self._overlayMountHook)
+            rootObj.addHook("earlyprebuild", self._overlayMountHook)
+            rootObj.addHook("postinit", self._treeCreate)
+            rootObj.addHook("clean", self._overlayCleanHook)
+        elif self.method == 'reflink':
+            # each clean chroot is a copy of the tree: reflinks where the
+            # filesystem can (btrfs, xfs with reflink=1), a hardlink farm
+            # otherwise
+            self.treeLink = os.path.join(self.rootSharedCachePath, "tree-%s" % self.cacheKey)
+            rootObj.addHook("preinit", self._reflinkPreInitHook)
+            rootObj.addHook("postinit", self._treeCreate)
+        else:
+            rootObj.addHook("preinit", self._rootCachePreInitHook)
+            rootObj.addHook("preshell", self._rootCachePreShellHook)
+            rootObj.addHook("prechroot", self._rootCachePreShellHook)
+            rootObj.addHook("preyum", self._rootCachePreYumHook)
+            rootObj.addHook("postinit", self._rootCachePostInitHook)
+            rootObj.addHook("postshell", self._rootCachePostShellHook)
+            rootObj.addHook("postchroot", self._rootCachePostShellHook)
+            rootObj.addHook("postyum", self._rootCachePostShellHook)
+        if self.root_cache_opts['deps_cache']:
+            rootObj.addHook("preinstalldeps", self._depsCachePreInstallDepsHook)
+            rootObj.addHook("postinstalldeps", self._depsCachePostInstallDepsHook)
+
     # =============
     # 'Private' API
     # =============
     decorate(traceLog())
-    def _rootCacheLock(self, shared=1):
-        lockType = fcntl.LOCK_EX
-        if shared: lockType = fcntl.LOCK_SH
-        try:
-            fcntl.lockf(self.rootCacheLock.fileno(), lockType | fcntl.LOCK_NB)
-        except IOError, e:
-            self.rootObj.start("Waiting for rootcache lock")
-            fcntl.lockf(self.rootCacheLock.fileno(), lockType)
-            self.rootObj.finish("Waiting for rootcache lock")
+    def _cacheKey(self):
+        """hash of the config settings that go into the cached chroot.
+           Unlike the mtimes of the config files, this does not change with
+           edits that make no difference to it."""
+        key = hashlib.sha256()
+        key.update("yum.conf\n%s\n" % self.rootObj.yum_conf_content)
+        key.update("chroot_setup_cmd\n%s\n" % " ".join(self.rootObj.chroot_setup_cmd))
+        for name in sorted(self.rootObj.chroot_file_contents.keys()):
+            key.update("file %s\n%s\n" % (name, self.rootObj.chroot_file_contents[name]))
+        for name in sorted(self.rootObj.macros.keys()):
+            key.update("macro %s %s\n" % (name, self.rootObj.macros[name]))
+        key.update("target_arch %s\n" % self.rootObj.target_arch)
+        return key.hexdigest()[:16]
 
     decorate(traceLog())
-    def _rootCacheUnlock(self):
-        fcntl.lockf(self.rootCacheLock.fileno(), fcntl.LOCK_UN)
+    def _writerLock(self, name):
+        """lock for writing the cache entry name, or None when another mock
+           is writing it already. Readers never lock: entries are written
+           to a temporary name and renamed into place when complete, and a
+           reader still unpacking the previous one keeps it open until it
+           is done. Closing the returned file unlocks."""
+        lockFile = open(os.path.join(self.rootSharedCachePath, "%s.lock" % name), "a+")
+        try:
+            fcntl.lockf(lockFile.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            lockFile.close()
+            getLog().info("another mock is writing %s; leaving it to that one" % name)
+            return None
+        return lockFile
 
     decorate(traceLog())
     def _rootCachePreInitHook(self):
-        getLog().info("enabled root cache")
+        getLog().info("enabled root cache (key %s)" % self.cacheKey)
         self._unpack_root_cache()
 
     decorate(traceLog())
     def _unpack_root_cache(self):
-        # check cache status
-        try:
-            if self.root_cache_opts['age_check']:
-                # see if it aged out
-                statinfo = os.stat(self.rootCacheFile)
-                file_age_days = (time.time() - statinfo.st_ctime) / (60 * 60 * 24)
-                if file_age_days > self.root_cache_opts['max_age_days']:
-                    getLog().info("root cache aged out! cache will be rebuilt")
-                    os.unlink(self.rootCacheFile)
-                else:
-                    # make sure no config file is newer than the cache file
-                    for cfg in self.rootObj.configs:
-                        if os.stat(cfg).st_mtime > statinfo.st_mtime:
-                            getLog().info("%s newer than root cache; cache will be rebuilt" % cfg)
-                            os.unlink(self.rootCacheFile)
-                            break
-            else:
-                getLog().info("skipping root_cache aging check")
-        except OSError:
-            pass
+        # check cache status. Config changes that matter give a different
+        # cache key, so only the age is checked; that also removes the
+        # caches of other keys nobody has refreshed in a while.
+        if self.root_cache_opts['age_check']:
+            for cacheFile in glob(os.path.join(self.rootSharedCachePath, "cache-*.tar*")):
+                try:
+                    file_age_days = (time.time() - os.stat(cacheFile).st_ctime) / (60 * 60 * 24)
+                    if file_age_days > self.root_cache_opts['max_age_days']:
+                        if cacheFile == self.rootCacheFile:
+                            getLog().info("root cache aged out! cache will be rebuilt")
+                        os.unlink(cacheFile)
+                except OSError:
+                    pass
+        else:
+            getLog().info("skipping root_cache aging check")
 
         mockbuild.util.mkdirIfAbsent(self.rootSharedCachePath)
-        # lock so others dont accidentally use root cache while we operate on it.
-        if self.rootCacheLock is None:
-            self.rootCacheLock = open(os.path.join(self.rootSharedCachePath, "rootcache.lock"), "a+")
 
         # optimization: don't unpack root cache if chroot was not cleaned (unless we are using tmpfs)
         if os.path.exists(self.rootCacheFile):
             if self.rootObj.chrootWasCleaned or self.rootObj.pluginConf['tmpfs_enable']:
                 self.rootObj.start("unpacking root cache")
-                self._rootCacheLock()
+                self._checkUpdateThreshold(self.rootCacheFile)
                 #
                 # deal with NFS homedir and root_squash
                 #
@@ -118,11 +222,26 @@ class RootCache(object):
                     )
                 for dir in self.exclude_dirs:
                     mockbuild.util.mkdirIfAbsent(self.rootObj.makeChrootPath(dir))
-                self._rootCacheUnlock()
                 self.rootObj.chrootWasCleaned = False
                 self.rootObj.chrootWasCached = True
                 self.rootObj.finish("unpacking root cache")
 
+    decorate(traceLog())
+    def _checkUpdateThreshold(self, path):
+        """skip the yum update of init when the cache at path was made or
+           refreshed less than update_threshold_hours ago"""
+        self.rootObj.skipYumUpdate = False
+        threshold = self.root_cache_opts['update_threshold_hours']
+        if not threshold or self.rootObj.refreshRootCache:
+            return
+        try:
+            age_hours = (time.time() - os.stat(path).st_mtime) / (60 * 60)
+        except OSError:
+            return
+        if age_hours < threshold:
+            getLog().info("root cache is %.1f hours old; skipping yum update" % age_hours)
+            self.rootObj.skipYumUpdate = True
+
     decorate(traceLog())
     def _rootCachePreShellHook(self):
         if self.rootObj.pluginConf['tmpfs_enable']:
@@ -148,49 +267,435 @@ class RootCache(object):
 
     decorate(traceLog())
     def _rebuild_root_cache(self):
-        try:
-            self._rootCacheLock(shared=0)
-            # nuke any rpmdb tmp files
-            self.rootObj._nuke_rpm_db()
+        # nuke any rpmdb tmp files
+        self.rootObj._nuke_rpm_db()
 
-            # truncate the sparse files in /var/log
-            for logfile in ('/var/log/lastlog', '/var/log/faillog'):
-                try:
-                    f = open(self.rootObj.makeChrootPath(logfile), "w")
-                    f.truncate(0)
-                    f.close()
-                except:
-                    pass
+        # truncate the sparse files in /var/log
+        for logfile in ('/var/log/lastlog', '/var/log/faillog'):
+            try:
+                f = open(self.rootObj.makeChrootPath(logfile), "w")
+                f.truncate(0)
+                f.close()
+            except:
+                pass
 
-            # never rebuild cache unless it was a clean build, or we are explicitly caching alterations
-            if self.rootObj.chrootWasCleaned or self.rootObj.cache_alterations:
+        # never rebuild cache unless it was a clean build, or we are explicitly caching alterations
+        if self.rootObj.chrootWasCleaned or self.rootObj.cache_alterations or self.rootObj.refreshRootCache:
+            lock = self._writerLock("cache-%s" % self.cacheKey)
+            if lock is None:
+                return
+            try:
                 mockbuild.util.do(["sync"], shell=False)
                 self._root_cache_handle_mounts()
                 self.rootObj.start("creating cache")
+                # pack into a file of our own and rename it into place, so
+                # builds unpacking the cache meanwhile are not disturbed
+                tmp = "%s.tmp.%d" % (self.rootCacheFile, os.getpid())
                 try:
                     mockbuild.util.do(
-                        ["tar", "--one-file-system"] + self.compressArgs + ["-cf", self.rootCacheFile,
+                        ["tar", "--one-file-system"] + self.compressArgs + ["-cf", tmp,
                                                        "-C", self.rootObj.makeChrootPath()] +
                         self.exclude_tar_cmds + ["."],
                         shell=False
                         )
+                    os.rename(tmp, self.rootCacheFile)
                 except:
-                    if os.path.exists(self.rootCacheFile):
-                        os.remove(self.rootCacheFile)
+                    if os.path.exists(tmp):
+                        os.remove(tmp)
                     raise
                 # now create the cache log file
                 try:
-                    l = open(os.path.join(self.rootSharedCachePath, "cache.log"), "w")
+                    l = open(os.path.join(self.rootSharedCachePath, "cache-%s.log" % self.cacheKey), "w")
                     l.write(self.rootObj.yum_init_install_output)
                     l.close()
                 except:
                     pass
                 self.rootObj.finish("creating cache")
-        finally:
-            self._rootCacheUnlock()
+            finally:
+                lock.close()
 
     decorate(traceLog())
     def _rootCachePostShellHook(self):
         if self.rootObj.pluginConf['tmpfs_enable'] and self.rootObj.cache_alterations:
             self._rebuild_root_cache()
 
+    #
+    # deps cache: the chroot once the build deps are installed, for both
+    # methods
+    #
+    decorate(traceLog())
+    def _depsCacheKey(self):
+        """hash of the pkgs in the chroot before the build deps are
+           installed and of the pkgs yum resolves the build deps to now"""
+        try:
+            output = self.rootObj._yum(['resolvedep'] + self.rootObj.buildDeps, returnOutput=1)
+        except mockbuild.exception.YumError, e:
+            getLog().info("deps cache: could not resolve the build deps: %s" % e)
+            return None
+        resolved = [l.strip() for l in output.split("\n") if resolved_re.match(l.strip())]
+        installed = self.rootObj.doNonChroot(
+            ["rpm", "--root", self.rootObj.makeChrootPath(), "-qa", "--qf", "%{NEVRA}\n"],
+            shell=False, returnOutput=1)
+        key = hashlib.sha256()
+        key.update("target_arch %s\n" % self.rootObj.target_arch)
+        key.update("installed\n%s\n" % "\n".join(sorted(installed.split())))
+        key.update("resolved\n%s\n" % "\n".join(sorted(set(resolved))))
+        return key.hexdigest()[:16]
+    decorate(traceLog())
+    def _depsCachePreInstallDepsHook(self):
+        self.depsCacheFile = None
+        if not self.rootObj.buildDeps:
+            return
+        mockbuild.util.mkdirIfAbsent(self.rootSharedCachePath)
+        if self.root_cache_opts['age_check']:
+            for cacheFile in glob(os.path.join(self.rootSharedCachePath, "deps-*.tar*")):
+                try:
+                    file_age_days = (time.time() - os.stat(cacheFile).st_ctime) / (60 * 60 * 24)
+                    if file_age_days > self.root_cache_opts['max_age_days']:
+                        os.unlink(cacheFile)
+                except OSError:
+                    pass
+
+        self.depsKey = self._depsCacheKey()
+        if self.depsKey is None:
+            return
+        self.depsCacheFile = os.path.join(self.rootSharedCachePath, "deps-%s.tar%s" % (self.depsKey, self.extension))
+        if not os.path.exists(self.depsCacheFile):
+            getLog().info("deps cache: no entry %s" % self.depsKey)
+            return
+        # yum still runs afterwards; with the deps already there it has
+        # nothing to install
+        self.rootObj.start("unpacking deps cache")
+        try:
+            mockbuild.util.do(
+                ["tar"] + self.compressArgs + ["-xf", self.depsCacheFile, "-C", self.rootObj.makeChrootPath()],
+                shell=False
+                )
+            getLog().info("deps cache: using entry %s" % self.depsKey)
+            # nothing new to store
+            self.depsCacheFile = None
+        finally:
+            self.rootObj.finish("unpacking deps cache")
+
+    decorate(traceLog())
+    def _depsCachePostInstallDepsHook(self):
+        if self.depsCacheFile is None or os.path.exists(self.depsCacheFile):
+            return
+        lock = self._writerLock("deps-%s" % self.depsKey)
+        if lock is None:
+            return
+        try:
+            self.rootObj._nuke_rpm_db()
+            self._root_cache_handle_mounts()
+            self.rootObj.start("creating deps cache")
+            # the srpm is unpacked in the home dir already, that is not kept
+            tmp = "%s.tmp.%d" % (self.depsCacheFile, os.getpid())
+            try:
+                mockbuild.util.do(
+                    ["tar", "--one-file-system"] + self.compressArgs + ["-cf", tmp,
+                                                   "-C", self.rootObj.makeChrootPath()] +
+                    self.exclude_tar_cmds + ["--exclude=.%s" % self.rootObj.homedir, "."],
+                    shell=False
+                    )
+                os.rename(tmp, self.depsCacheFile)
+            except:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+                raise
+            self.depsCacheFile = None
+            self.rootObj.finish("creating deps cache")
+        finally:
+            lock.close()
+
+    #
+    # cache kept as a directory tree, for the 'overlay' and 'reflink'
+    # methods
+    #
+    decorate(traceLog())
+    def _treeUseGeneration(self, record=True):
+        """pick the generation of the cache the chroot is made from: the one
+           recorded for it, or the current one for a new chroot. A shared
+           lock on it is held until _treeReleaseGeneration(), so it is not
+           garbage collected meanwhile. With record, the generation is
+           recorded for the chroot, which keeps it from being garbage
+           collected for as long as the chroot exists.
+           returns False if there is none"""
+        if self.treeLock is not None:
+            return True
+        while True:
+            if record and os.path.exists(self.treeRecord):
+                gen = open(self.treeRecord).read().strip()
+                if not os.path.isdir(gen):
+                    raise mockbuild.exception.RootError, "the root cache %s was made from is gone; clean the chroot" % self.rootObj.makeChrootPath()
+            elif os.path.isdir(self.treeLink):
+                gen = os.path.realpath(self.treeLink)
+            else:
+                return False
+            lockFile = open(gen + ".lock", "a+")
+            try:
+                fcntl.flock(lockFile.fileno(), fcntl.LOCK_SH | fcntl.LOCK_NB)
+            except IOError:
+                # it is being garbage collected; the link points elsewhere
+                lockFile.close()
+                time.sleep(1)
+                continue
+            if not os.path.isdir(gen):
+                lockFile.close()
+                continue
+            break
+        if record and not os.path.exists(self.treeRecord):
+            mockbuild.util.mkdirIfAbsent(os.path.dirname(self.treeRecord))
+            f = open(self.treeRecord, "w")
+            f.write(gen + "\n")
+            f.close()
+        self.treeDir = gen
+        self.treeLock = lockFile
+        return True
+
+    decorate(traceLog())
+    def _treeReleaseGeneration(self):
+        if self.treeLock is not None:
+            self.treeLock.close()
+            self.treeLock = None
+            self.treeDir = None
+
+    decorate(traceLog())
+    def _treeCollectGarbage(self):
+        """remove the generations of the cache that are neither current nor
+           recorded by a chroot nor locked by a running mock"""
+        used = set()
+        for record in glob(os.path.join(os.path.dirname(self.rootObj.basedir), "*", "overlay", "lower")):
+            try:
+                used.add(open(record).read().strip())
+            except IOError:
+                pass
+        for gen in glob(self.treeLink + ".*"):
+            if os.path.islink(gen) or not os.path.isdir(gen) or ".tmp." in gen:
+                continue
+            gen = os.path.realpath(gen)
+            if gen in used:
+                continue
+            lockFile = open(gen + ".lock", "a+")
+            try:
+                try:
+                    fcntl.flock(lockFile.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError:
+                    continue
+                if os.path.realpath(self.treeLink) == gen:
+                    continue
+                getLog().info("removing unused root cache %s" % os.path.basename(gen))
+                mockbuild.util.rmtree(gen, selinux=self.rootObj.selinux)
+                os.unlink(gen + ".lock")
+            finally:
+                lockFile.close()
+
+    decorate(traceLog())
+    def _treePublish(self, gen):
+        """make gen the current generation"""
+        if os.path.isdir(self.treeLink) and not os.path.islink(self.treeLink):
+            # a tree from before generations were kept becomes one
+            os.rename(self.treeLink, "%s.%d.0" % (self.treeLink, os.stat(self.treeLink).st_mtime))
+        link = "%s.new.%d" % (self.treeLink, os.getpid())
+        if os.path.lexists(link):
+            os.unlink(link)
+        os.symlink(os.path.basename(gen), link)
+        os.rename(link, self.treeLink)
+
+    decorate(traceLog())
+    def _treeAgeCheck(self):
+        if self.root_cache_opts['age_check'] and os.path.isdir(self.treeLink):
+            file_age_days = (time.time() - os.stat(self.treeLink).st_mtime) / (60 * 60 * 24)
+            if file_age_days > self.root_cache_opts['max_age_days']:
+                # chroots made from it keep using it, it is garbage
+                # collected once none is left
+                getLog().info("root cache aged out! cache will be rebuilt")
+                lock = self._writerLock(os.path.basename(self.treeLink))
+                if lock is not None:
+                    try:
+                        if os.path.islink(self.treeLink):
+                            os.unlink(self.treeLink)
+                        elif os.path.isdir(self.treeLink):
+                            os.rename(self.treeLink, "%s.%d.0" % (self.treeLink, time.time()))
+                    finally:
+                        lock.close()
+        self._treeCollectGarbage()
+
+    decorate(traceLog())
+    def _treeCreate(self):
+        """copy the chroot to a new generation of the cache after a clean
+           init, or after a refresh"""
+        # a refresh copies the updated chroot, as seen through the overlay
+        # for that method, to a new generation
+        refresh = self.rootObj.refreshRootCache and self.rootObj.chrootWasCached
+        if not refresh and (not self.rootObj.chrootWasCleaned or os.path.isdir(self.treeLink)):
+            return
+        lock = self._writerLock(os.path.basename(self.treeLink))
+        if lock is None:
+            return
+        try:
+            if not refresh and os.path.isdir(self.treeLink):
+                return
+            self.rootObj._nuke_rpm_db()
+            mockbuild.util.do(["sync"], shell=False)
+            self.rootObj.start("creating cache")
+            # fill a temporary dir first, a partial generation must never be
+            # used. -x leaves out the contents of proc, sys and the other
+            # mounts in the chroot.
+            gen = "%s.%d.%d" % (self.treeLink, time.time(), os.getpid())
+            tmp = "%s.tmp.%d" % (self.treeLink, os.getpid())
+            cp = ["cp", "-a", "-x"]
+            if self.method == 'reflink':
+                cp.append("--reflink=auto")
+            try:
+                mockbuild.util.do(cp + [self.rootObj.makeChrootPath() + "/.", tmp], shell=False)
+                for dir in self.exclude_dirs:
+                    path = os.path.join(tmp, dir)
+                    mockbuild.util.rmtree(path, selinux=self.rootObj.selinux)
+                    mockbuild.util.mkdirIfAbsent(path)
+                os.rename(tmp, gen)
+            finally:
+                mockbuild.util.rmtree(tmp, selinux=self.rootObj.selinux)
+            # its age is checked by its mtime
+            os.utime(gen, None)
+            self._treePublish(gen)
+            self.rootObj.finish("creating cache")
+        finally:
+            lock.close()
+        self._treeCollectGarbage()
+
+    #
+    # 'overlay' method
+    #
+    decorate(traceLog())
+    def _overlayMount(self):
+        if self.overlay.ismounted():
+            self.overlay.mounted = True
+            return
+        self.overlay.mounted = False
+        if not self._treeUseGeneration():
+            raise mockbuild.exception.RootError, "no root cache to mount on %s" % self.rootObj.makeChrootPath()
+        self.overlay.options = 'lowerdir=%s,upperdir=%s,workdir=%s' % (self.treeDir, self.upperDir, self.workDir)
+        mockbuild.util.mkdirIfAbsent(self.upperDir)
+        mockbuild.util.mkdirIfAbsent(self.workDir)
+        mockbuild.util.mkdirIfAbsent(self.rootObj.makeChrootPath())
+        if not self.overlay.mount():
+            raise mockbuild.exception.RootError, "could not mount the root cache overlay on %s" % self.rootObj.makeChrootPath()
+
+    decorate(traceLog())
+    def _overlayPreInitHook(self):
+        getLog().info("enabled root cache (overlay, key %s)" % self.cacheKey)
+        mockbuild.util.mkdirIfAbsent(self.rootSharedCachePath)
+        self._treeAgeCheck()
+
+        if self.rootObj.chrootWasCleaned and not os.path.isdir(self.treeLink):
+            # nothing cached yet, the chroot gets set up the usual way
+            # and is copied to the cache in postinit
+            return
+        if os.path.exists(self.upperDir) or self.rootObj.chrootWasCleaned:
+            self.rootObj.start("mounting root cache overlay")
+            self._overlayMount()
+            if self.rootObj.chrootWasCleaned:
+                self._checkUpdateThreshold(self.treeDir)
+                self.rootObj.chrootWasCleaned = False
+                self.rootObj.chrootWasCached = True
+            self.rootObj.finish("mounting root cache overlay")
+
+    decorate(traceLog())
+    def _overlayMountHook(self):
+        # chroots set up from the cache need the overlay in every mock run
+        if os.path.exists(self.upperDir):
+            self._overlayMount()
+
+    decorate(traceLog())
+    def _overlayCleanHook(self):
+        # what is mounted on top of it first
+        self.rootObj._umountall(nowarn=True)
+        if self.overlay.ismounted():
+            self.overlay.mounted = True
+            self.overlay.umount()
+        # the chroot and its record go away, the generation may too
+        self._treeReleaseGeneration()
+
+    #
+    # 'reflink' method
+    #
+    decorate(traceLog())
+    def _reflinkProbe(self, dst):
+        """how files of the cache can be put in dst: 'reflinks' where the
+           filesystem does copy-on-write, 'hardlinks' where it is the same
+           one as the cache's, a plain 'copy' otherwise. Tried with a
+           single file, a cp of the whole tree would go on through every
+           file when the first could not be reflinked."""
+        probe = os.path.join(self.rootSharedCachePath, "reflink-probe.%d" % os.getpid())
+        target = os.path.join(dst, ".reflink-probe.%d" % os.getpid())
+        f = open(probe, "w")
+        f.write("probe\n")
+        f.close()
+        try:
+            try:
+                mockbuild.util.do(["cp", "--reflink=always", probe, target], shell=False)
+                return "reflinks"
+            except mockbuild.exception.Error:
+                # cp leaves an empty file behind
+                if os.path.exists(target):
+                    os.unlink(target)
+            try:
+                os.link(probe, target)
+                return "hardlinks"
+            except OSError:
+                return "copy"
+        finally:
+            for path in (probe, target):
+                if os.path.exists(path):
+                    os.unlink(path)
+
+    decorate(traceLog())
+    def _reflinkPopulate(self):
+        """fill the empty chroot from the tree, as cheaply as the
+           filesystem allows. returns how it was done"""
+        src = self.treeDir + "/."
+        dst = self.rootObj.makeChrootPath()
+        mockbuild.util.mkdirIfAbsent(dst)
+        how = self._reflinkProbe(dst)
+        if how == "reflinks":
+            mockbuild.util.do(["cp", "-a", "--reflink=always", src, dst], shell=False)
+            return how
+        if how == "copy":
+            mockbuild.util.do(["cp", "-a", src, dst], shell=False)
+            return how
+        mockbuild.util.do(["cp", "-a", "-l", src, dst], shell=False)
+        # files are replaced by rpm (by rename), which leaves the cache
+        # alone, but these are written to in place: give the chroot copies
+        # of its own
+        for dir in reflink_copyup_dirs + [self.rootObj.homedir]:
+            path = self.rootObj.makeChrootPath(dir)
+            if os.path.islink(path) or not os.path.isdir(path):
+                continue
+            mockbuild.util.rmtree(path, selinux=self.rootObj.selinux)
+            mockbuild.util.do(["cp", "-a", os.path.join(self.treeDir, dir.lstrip('/')), path], shell=False)
+        return how
+
+    decorate(traceLog())
+    def _reflinkPreInitHook(self):
+        getLog().info("enabled root cache (reflink, key %s)" % self.cacheKey)
+        mockbuild.util.mkdirIfAbsent(self.rootSharedCachePath)
+        self._treeAgeCheck()
+
+        if not self.rootObj.chrootWasCleaned:
+            return
+        # the chroot does not refer to the tree once populated, so the
+        # generation is not recorded for it
+        if not self._treeUseGeneration(record=False):
+            return
+        try:
+            self.rootObj.start("populating chroot from root cache")
+            self._checkUpdateThreshold(self.treeDir)
+            how = self._reflinkPopulate()
+            getLog().info("root cache: chroot populated with %s" % how)
+            for dir in self.exclude_dirs:
+                mockbuild.util.mkdirIfAbsent(self.rootObj.makeChrootPath(dir))
+            self.rootObj.chrootWasCleaned = False
+            self.rootObj.chrootWasCached = True
+            self.rootObj.finish("populating chroot from root cache")
+        finally:
+            self._treeReleaseGeneration()
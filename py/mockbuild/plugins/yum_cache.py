@@ -4,7 +4,12 @@
 # Copyright (C) 2007 Michael E Brown <mebrown@michaels-house.net>
 
 # python library imports
+import errno
 import fcntl
+import hashlib
+import json
+import sqlite3
+import stat
 import time
 import os
 import glob
@@ -17,11 +22,35 @@ from mockbuild.mounts import BindMountPoint
 # set up logging, module options
 requires_api_version = "1.0"
 
+# files of the yum cache that are not yum's
+own_files = ("yumcache.lock", "manifest.json")
+
 # plugin entry point
 decorate(traceLog())
 def init(rootObj, conf):
     YumCache(rootObj, conf)
 
+def fileSha256(path):
+    checksum = hashlib.sha256()
+    f = open(path, 'rb')
+    try:
+        while True:
+            data = f.read(1024 * 1024)
+            if not data:
+                break
+            checksum.update(data)
+    finally:
+        f.close()
+    return checksum.hexdigest()
+
+def fileKind(filename):
+    if filename.endswith(".rpm"):
+        return "package"
+    for ext in (".sqlite", ".xml", ".bz2", ".gz"):
+        if filename.endswith(ext):
+            return "metadata"
+    return "other"
+
 # classes
 class YumCache(object):
     """caches root environment in a tarball"""
@@ -38,6 +67,40 @@ class YumCache(object):
         rootObj.mounts.add(BindMountPoint(srcpath=self.yumSharedCachePath, bindpath=rootObj.makeChrootPath('/var/cache/yum')))
         mockbuild.util.mkdirIfAbsent(self.yumSharedCachePath)
         self.yumCacheLock = open(os.path.join(self.yumSharedCachePath, "yumcache.lock"), "a+")
+        # what is in the yum cache and since when, so expiring files does
+        # not need to look at all of them. Kept up to date after every yum
+        # run, looking only in the dirs whose mtime changed.
+        self.manifestPath = os.path.join(self.yumSharedCachePath, "manifest.json")
+        self.manifest = None
+        self.manifestStat = None
+        # pkgs downloaded for any config are kept once in the package pool,
+        # named by their sha256, and hardlinked into the packages dirs of
+        # the yum caches. The link count of a pkg in the pool says how many
+        # yum caches use it.
+        self.poolPath = None
+        if self.yum_cache_opts['package_pool']:
+            self.poolPath = self.yum_cache_opts['package_pool_dir'] % self.yum_cache_opts
+            mockbuild.util.mkdirIfAbsent(self.poolPath)
+        self.poolPrefilled = False
+        self.readOnly = False
+
+    # =============
+    # 'Public' API
+    # =============
+    decorate(traceLog())
+    def prune(self):
+        """expire old files of the yum cache (and the package pool), after
+           checking all of the cache, for mock --prune-yum-cache"""
+        self._yumCacheLock()
+        try:
+            self.rootObj.start("pruning yum cache")
+            self._manifestUpdate(full=True)
+            self._manifestExpire()
+            if self.poolPath:
+                self._poolPrune()
+            self.rootObj.finish("pruning yum cache")
+        finally:
+            self._yumCacheUnlock()
 
     # =============
     # 'Private' API
@@ -46,55 +109,367 @@ class YumCache(object):
     # by yum, and prior to cleaning it. This prevents simultaneous access from
     # screwing things up. This can possibly happen, eg. when running multiple
     # mock instances with --uniqueext=
+    # yums that only read the cache share the lock. Which repos a yum
+    # writes to is only known inside of it, so the others lock all of it.
     decorate(traceLog())
-    def _yumCachePreYumHook(self):
+    def _yumCacheLock(self, shared=False):
+        lockType = fcntl.LOCK_EX
+        if shared:
+            lockType = fcntl.LOCK_SH
+        # a yum that failed never got to postyum; changing the kind of a
+        # lock still held could deadlock with another mock doing the same
+        fcntl.lockf(self.yumCacheLock.fileno(), fcntl.LOCK_UN)
         try:
-            fcntl.lockf(self.yumCacheLock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            fcntl.lockf(self.yumCacheLock.fileno(), lockType | fcntl.LOCK_NB)
         except IOError, e:
             self.rootObj.start("Waiting for yumcache lock")
-            fcntl.lockf(self.yumCacheLock.fileno(), fcntl.LOCK_EX)
+            fcntl.lockf(self.yumCacheLock.fileno(), lockType)
             self.rootObj.finish("Waiting for yumcache lock")
 
     decorate(traceLog())
-    def _yumCachePostYumHook(self):
+    def _yumCacheUnlock(self):
         fcntl.lockf(self.yumCacheLock.fileno(), fcntl.LOCK_UN)
 
+    decorate(traceLog())
+    def _yumCachePreYumHook(self):
+        # with -C yum neither downloads metadata nor pkgs
+        self.readOnly = "-C" in (self.rootObj.yumCommand or [])
+        if self.poolPath and not self.poolPrefilled and not self.readOnly:
+            # linking pkgs in only adds files, which the yums sharing the
+            # lock do not mind
+            self._yumCacheLock(shared=True)
+            self._poolPrefill()
+        self._yumCacheLock(shared=self.readOnly)
+
+    decorate(traceLog())
+    def _yumCachePostYumHook(self):
+        try:
+            if not self.readOnly:
+                new = self._manifestUpdate()
+                if self.poolPath and new:
+                    self._poolCollect(new)
+        finally:
+            self._yumCacheUnlock()
+
     decorate(traceLog())
     def _yumCachePreInitHook(self):
         getLog().info("enabled yum cache")
         mockbuild.util.mkdirIfAbsent(self.rootObj.makeChrootPath('/var/cache/yum'))
 
         # lock so others dont accidentally use yum cache while we operate on it.
-        self._yumCachePreYumHook()
-
-        if self.online:
-            self.rootObj.start("cleaning yum metadata")
-            for (dirpath, dirnames, filenames) in os.walk(self.yumSharedCachePath):
-                for filename in filenames:
-                    fullPath = os.path.join(dirpath, filename)
-                    statinfo = os.stat(fullPath)
-                    file_age_days = (time.time() - statinfo.st_ctime) / (60 * 60 * 24)
-                    # prune repodata so yum redownloads.
-                    # prevents certain errors where yum gets stuck due to bad metadata
-                    for ext in (".sqlite", ".xml", ".bz2", ".gz"):
-                        if filename.endswith(ext) and file_age_days > self.yum_cache_opts['max_metadata_age_days']:
-                            os.unlink(fullPath)
-                            fullPath = None
-                            break
-
-                    if fullPath is None: continue
-                    if file_age_days > self.yum_cache_opts['max_age_days']:
-                        os.unlink(fullPath)
+        self._yumCacheLock()
+        try:
+            if self.online and self.yum_cache_opts['prune_on_init']:
+                self.rootObj.start("cleaning yum metadata")
+                self._manifestUpdate()
+                self._manifestExpire()
+                self.rootObj.finish("cleaning yum metadata")
+
+            # yum made an rpmdb cache dir in $cachedir/installed for a while;
+            # things can go wrong in a specific mock case if this happened.
+            # So - just nuke the dir and all that's in it.
+            if os.path.exists(self.yumSharedCachePath + '/installed'):
+                for fn in glob.glob(self.yumSharedCachePath + '/installed/*'):
+                    os.unlink(fn)
+                os.rmdir(self.yumSharedCachePath + '/installed')
+        finally:
+            self._yumCacheUnlock()
+
+    #
+    # manifest
+    #
+    decorate(traceLog())
+    def _manifestLoad(self):
+        """the manifest as saved, unless the copy in memory is that one"""
+        try:
+            statinfo = os.stat(self.manifestPath)
+        except OSError:
+            return None
+        key = (statinfo.st_ino, statinfo.st_mtime, statinfo.st_size)
+        if self.manifest is not None and self.manifestStat == key:
+            return self.manifest
+        try:
+            f = open(self.manifestPath)
+            try:
+                manifest = json.load(f)
+            finally:
+                f.close()
+        except (IOError, ValueError), e:
+            getLog().debug("yum cache manifest unusable: %s" % e)
+            return None
+        if manifest.get('version') != 1:
+            return None
+        return manifest
+
+    decorate(traceLog())
+    def _manifestSave(self):
+        tmp = "%s.tmp.%d" % (self.manifestPath, os.getpid())
+        f = open(tmp, "w")
+        try:
+            json.dump(self.manifest, f)
+        finally:
+            f.close()
+        os.rename(tmp, self.manifestPath)
+        statinfo = os.stat(self.manifestPath)
+        self.manifestStat = (statinfo.st_ino, statinfo.st_mtime, statinfo.st_size)
+
+    decorate(traceLog())
+    def _manifestUpdate(self, full=False):
+        """bring the manifest up to date with the yum cache. Unless full,
+           only the dirs whose mtime changed are listed, and in packages
+           dirs only the files not seen before are looked at.
+           returns the paths of the files that are new to it. It is only
+           saved again when something changed."""
+        manifest = None
+        if not full:
+            manifest = self._manifestLoad()
+        changed = False
+        if manifest is None:
+            manifest = {'version': 1, 'dirs': {}}
+            changed = True
+        dirs = manifest['dirs']
+        new = []
+        checked = set()
+        pending = [""]
+        while pending:
+            rel = pending.pop()
+            path = os.path.join(self.yumSharedCachePath, rel)
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                continue
+            checked.add(rel)
+            entry = previous = dirs.get(rel)
+            if entry is None or entry['mtime'] != mtime:
+                old = {}
+                if entry is not None:
+                    old = entry['files']
+                # pkgs do not change once downloaded; metadata files are
+                # replaced under the same name
+                restat = os.path.basename(rel) != "packages"
+                entry = {'mtime': mtime, 'subdirs': [], 'files': {}}
+                for name in os.listdir(path):
+                    if not rel and (name in own_files or name.startswith("manifest.json.tmp")):
+                        continue
+                    if name in old and not restat:
+                        entry['files'][name] = old[name]
+                        continue
+                    try:
+                        statinfo = os.lstat(os.path.join(path, name))
+                    except OSError:
                         continue
-            self.rootObj.finish("cleaning yum metadata")
+                    if stat.S_ISDIR(statinfo.st_mode):
+                        entry['subdirs'].append(name)
+                    elif stat.S_ISREG(statinfo.st_mode):
+                        if name not in old or old[name][0] != statinfo.st_ctime:
+                            new.append(os.path.join(path, name))
+                        entry['files'][name] = [statinfo.st_ctime, fileKind(name)]
+                dirs[rel] = entry
+                # a new mtime alone is not worth saving: saving the
+                # manifest changes the mtime of the top dir every time
+                if previous is None or previous['files'] != entry['files'] or \
+                   sorted(previous['subdirs']) != sorted(entry['subdirs']):
+                    changed = True
+            for name in entry['subdirs']:
+                pending.append(os.path.join(rel, name))
+        # dirs removed meanwhile
+        for rel in dirs.keys():
+            if rel not in checked:
+                del dirs[rel]
+                changed = True
+        self.manifest = manifest
+        if changed:
+            self._manifestSave()
+        else:
+            # what is in memory is what is saved, see _manifestLoad()
+            statinfo = os.stat(self.manifestPath)
+            self.manifestStat = (statinfo.st_ino, statinfo.st_mtime, statinfo.st_size)
+        return new
+
+    decorate(traceLog())
+    def _manifestExpire(self):
+        """remove the files that are too old according to the manifest;
+           metadata goes sooner so yum downloads it again, which prevents
+           certain errors where yum gets stuck due to bad metadata"""
+        now = time.time()
+        removed = 0
+        for (rel, entry) in self.manifest['dirs'].items():
+            for (name, (ctime, kind)) in entry['files'].items():
+                file_age_days = (now - ctime) / (60 * 60 * 24)
+                if file_age_days > self.yum_cache_opts['max_age_days'] or \
+                   (kind == "metadata" and file_age_days > self.yum_cache_opts['max_metadata_age_days']):
+                    try:
+                        os.unlink(os.path.join(self.yumSharedCachePath, rel, name))
+                    except OSError:
+                        pass
+                    del entry['files'][name]
+                    removed += 1
+        if removed:
+            getLog().debug("yum cache: %d files expired" % removed)
+            self._manifestSave()
 
-        # yum made an rpmdb cache dir in $cachedir/installed for a while;
-        # things can go wrong in a specific mock case if this happened.
-        # So - just nuke the dir and all that's in it.
-        if os.path.exists(self.yumSharedCachePath + '/installed'):
-            for fn in glob.glob(self.yumSharedCachePath + '/installed/*'):
-                os.unlink(fn)
-            os.rmdir(self.yumSharedCachePath + '/installed')
+    #
+    # package pool
+    #
+    decorate(traceLog())
+    def _poolObject(self, checksum):
+        return os.path.join(self.poolPath, checksum[:2], checksum + ".rpm")
+
+    decorate(traceLog())
+    def _poolRepos(self, manifest=None, only=None):
+        """yields the packages dir of every repo in the yum cache with
+           metadata, and the (sha256, file name) of the pkgs in it. With
+           only, {packages dir: file names}, just the rows of those pkgs
+           of those repos are read"""
+        if manifest is None:
+            manifest = self.manifest
+        # repos with sha1 checksums do not use the pool
+        query = "SELECT pkgId, location_href FROM packages WHERE checksum_type = 'sha256'"
+        for (rel, entry) in manifest['dirs'].items():
+            dirpath = os.path.join(self.yumSharedCachePath, rel)
+            pkgdir = os.path.join(dirpath, "packages")
+            if only is not None and pkgdir not in only:
+                continue
+            for filename in entry['files'].keys():
+                if not filename.endswith("primary.sqlite"):
+                    continue
+                try:
+                    db = sqlite3.connect(os.path.join(dirpath, filename))
+                    try:
+                        if only is None:
+                            rows = db.execute(query).fetchall()
+                        else:
+                            rows = []
+                            names = sorted(only[pkgdir])
+                            # sqlite takes 999 parameters at most
+                            for i in range(0, len(names), 400):
+                                chunk = names[i:i + 400]
+                                args = []
+                                for name in chunk:
+                                    args.extend((name, "%/" + name))
+                                cond = " OR ".join(["location_href = ? OR location_href LIKE ?"] * len(chunk))
+                                rows.extend(db.execute("%s AND (%s)" % (query, cond), args).fetchall())
+                    finally:
+                        db.close()
+                except sqlite3.Error, e:
+                    getLog().debug("package pool: cannot read %s: %s" % (os.path.join(dirpath, filename), e))
+                    continue
+                pkgs = [(pkgId, os.path.basename(href)) for (pkgId, href) in rows]
+                if only is not None:
+                    # LIKE takes a _ in a name for any character
+                    pkgs = [(pkgId, name) for (pkgId, name) in pkgs if name in only[pkgdir]]
+                yield (pkgdir, pkgs)
 
-        self._yumCachePostYumHook()
+    decorate(traceLog())
+    def _poolContents(self):
+        """the checksums of the pkgs in the pool, from listing its dirs"""
+        contents = set()
+        for subdir in os.listdir(self.poolPath):
+            try:
+                names = os.listdir(os.path.join(self.poolPath, subdir))
+            except OSError:
+                continue
+            for name in names:
+                if name.endswith(".rpm"):
+                    contents.add(name[:-4])
+        return contents
 
+    decorate(traceLog())
+    def _poolPrefill(self):
+        """link the pkgs of the repos of this config that are in the pool
+           into its packages dirs, so yum finds them downloaded already.
+           Goes by the repos in the manifest of the yum cache as saved and
+           by what the pool holds, so only the pkgs it links are touched."""
+        self.poolPrefilled = True
+        manifest = self._manifestLoad()
+        if manifest is None:
+            return
+        contents = self._poolContents()
+        if not contents:
+            return
+        linked = 0
+        for (pkgdir, pkgs) in self._poolRepos(manifest):
+            # a listing is cheap, and right also when the saved manifest
+            # is not
+            try:
+                present = set(os.listdir(pkgdir))
+            except OSError:
+                present = set()
+            wanted = [(checksum, filename) for (checksum, filename) in pkgs
+                      if checksum in contents and filename not in present]
+            if not wanted:
+                continue
+            mockbuild.util.mkdirIfAbsent(pkgdir)
+            for (checksum, filename) in wanted:
+                try:
+                    os.link(self._poolObject(checksum), os.path.join(pkgdir, filename))
+                    linked += 1
+                except OSError, e:
+                    # there already, or pruned meanwhile
+                    if e.errno in (errno.EEXIST, errno.ENOENT):
+                        continue
+                    if e.errno == errno.EXDEV:
+                        getLog().warning("package pool %s is not on the filesystem of %s; not using it"
+                                         % (self.poolPath, self.yumSharedCachePath))
+                        self.poolPath = None
+                        return
+                    raise
+        if linked:
+            getLog().info("package pool: %d pkgs linked into the yum cache" % linked)
+
+    decorate(traceLog())
+    def _poolCollect(self, new):
+        """put the pkgs yum downloaded (the new files of the yum cache) in
+           the pool, or replace them by the copy in the pool when it has one"""
+        new = set(new)
+        # only pkgs matter, and only the metadata of their repos
+        only = {}
+        for path in new:
+            pkgdir = os.path.dirname(path)
+            if path.endswith(".rpm") and os.path.basename(pkgdir) == "packages":
+                only.setdefault(pkgdir, set()).add(os.path.basename(path))
+        if not only:
+            return
+        for (pkgdir, pkgs) in self._poolRepos(only=only):
+            for (checksum, filename) in pkgs:
+                path = os.path.join(pkgdir, filename)
+                try:
+                    # linked to the pool already?
+                    if path not in new or os.stat(path).st_nlink > 1:
+                        continue
+                except OSError:
+                    continue
+                # a partial download does not match the metadata
+                if fileSha256(path) != checksum:
+                    continue
+                obj = self._poolObject(checksum)
+                mockbuild.util.mkdirIfAbsent(os.path.dirname(obj))
+                try:
+                    os.link(path, obj)
+                except OSError, e:
+                    if e.errno == errno.EEXIST:
+                        tmp = "%s.pool.%d" % (path, os.getpid())
+                        os.link(obj, tmp)
+                        os.rename(tmp, path)
+                    elif e.errno == errno.EXDEV:
+                        getLog().warning("package pool %s is not on the filesystem of %s; not using it"
+                                         % (self.poolPath, self.yumSharedCachePath))
+                        self.poolPath = None
+                        return
+                    else:
+                        raise
+
+    decorate(traceLog())
+    def _poolPrune(self):
+        """remove the pkgs no yum cache has used for max_age_days; the
+           ctime of a pkg changes whenever it is linked or unlinked"""
+        for (dirpath, dirnames, filenames) in os.walk(self.poolPath):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    statinfo = os.stat(path)
+                except OSError:
+                    continue
+                file_age_days = (time.time() - statinfo.st_ctime) / (60 * 60 * 24)
+                if statinfo.st_nlink == 1 and file_age_days > self.yum_cache_opts['max_age_days']:
+                    os.unlink(path)
@@ -0,0 +1,95 @@
+# vim:expandtab:autoindent:tabstop=4:shiftwidth=4:filetype=python:textwidth=0:
+# License: GPL2 or later see COPYING
+# Copyright (C) 2013 Red Hat, Inc
+
+# python library imports
+import fcntl
+import os
+import time
+
+# our imports
+from mockbuild.trace_decorator import traceLog, decorate, getLog
+import mockbuild.util
+
+# classes
+class ChrootPool(object):
+    """a number of buildroots for one config, named <root>-pool<N> like
+       --uniqueext would. Each is used by one mock at a time, which holds a
+       lock on <root>-pool<N>.lock next to them; the lock file is outside of
+       the buildroot so clean() can remove and recreate that. After a build
+       the buildroot is cleaned and initialized again in the background
+       while still locked, and <root>-pool<N>.ready is created, so the next
+       build can start in it right away."""
+    decorate(traceLog())
+    def __init__(self, config_opts, size):
+        self.size = size
+        self.basedir = config_opts['basedir']
+        self.root = config_opts['root']
+        self.slot = None
+        self.lockFile = None
+
+    def _path(self, slot, suffix):
+        return os.path.join(self.basedir, "%s-pool%d%s" % (self.root, slot, suffix))
+
+    decorate(traceLog())
+    def claim(self):
+        """lock a buildroot of the pool, waiting for one if they are all
+           in use. Ready ones are preferred. returns its uniqueext"""
+        mockbuild.util.mkdirIfAbsent(self.basedir)
+        waiting = False
+        while True:
+            slots = range(self.size)
+            slots.sort(key=lambda slot: not os.path.exists(self._path(slot, ".ready")))
+            for slot in slots:
+                lockFile = open(self._path(slot, ".lock"), "a+")
+                try:
+                    fcntl.flock(lockFile.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError:
+                    lockFile.close()
+                    continue
+                self.slot = slot
+                self.lockFile = lockFile
+                getLog().info("using buildroot %d of the pool" % slot)
+                return "pool%d" % slot
+            if not waiting:
+                getLog().info("all %d buildroots of the pool are in use, waiting" % self.size)
+                waiting = True
+            time.sleep(1)
+
+    decorate(traceLog())
+    def isReady(self):
+        """was the claimed buildroot initialized since it was last used.
+           Using it makes it not ready any more."""
+        ready = self._path(self.slot, ".ready")
+        if os.path.exists(ready):
+            os.unlink(ready)
+            return True
+        return False
+
+    decorate(traceLog())
+    def refresh(self, chroot):
+        """clean and init the buildroot in a child process which keeps the
+           lock until it is done, so this one can exit right away"""
+        pid = os.fork()
+        if pid:
+            self.lockFile.close()
+            return pid
+
+        status = 1
+        try:
+            try:
+                os.setsid()
+                devnull = os.open("/dev/null", os.O_RDWR)
+                for fd in (0, 1, 2):
+                    os.dup2(devnull, fd)
+                # the logs of the build are done, the refresh has its own
+                chroot.setResultDir(self._path(self.slot, "-refresh"))
+                chroot.clean_the_chroot = True
+                chroot.clean()
+                chroot.init()
+                open(self._path(self.slot, ".ready"), "w").close()
+                status = 0
+            except (Exception,), e:
+                getLog().exception(e)
+        finally:
+            os._exit(status)
@@ -0,0 +1,99 @@
+# vim:expandtab:autoindent:tabstop=4:shiftwidth=4:filetype=python:textwidth=0:
+# License: GPL2 or later see COPYING
+# Copyright (C) 2013 Red Hat, Inc
+
+# python library imports
+import json
+import os
+import resource
+import time
+
+# our imports
+from mockbuild.trace_decorator import traceLog, decorate, getLog
+import mockbuild.util
+
+# classes
+class Profiler(object):
+    """records where mock spends its time, for mock --profile. Each state
+       between Root.start() and Root.finish(), and each plugin hook that
+       Root._callHooks() runs, is a frame. Frames inside other frames make
+       a stack. For each frame it records:
+         - the wall clock time
+         - the CPU time of mock itself
+         - the CPU time of the commands it waited for (RUSAGE_CHILDREN)
+         - how many commands util.do() started
+       write() saves them in the resultdir in two files:
+         - profile.json, Chrome trace events, for chrome://tracing or
+           speedscope
+         - profile.folded, collapsed stacks with their own wall clock time
+           in microseconds, for flamegraph.pl"""
+    decorate(traceLog())
+    def __init__(self):
+        self.epoch = time.time()
+        self.pid = os.getpid()
+        # open frames: (name, category, sample at the start, wall clock
+        # time of the frames closed inside it)
+        self.stack = []
+        self.events = []
+        self.folded = {}
+
+    def _sample(self):
+        mine = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return (time.time(),
+                mine.ru_utime + mine.ru_stime,
+                children.ru_utime + children.ru_stime,
+                mockbuild.util.spawnCount)
+
+    def push(self, name, category="state"):
+        self.stack.append([name, category, self._sample(), 0.0])
+
+    def pop(self):
+        (name, category, start, inner) = self.stack.pop()
+        end = self._sample()
+        wall = end[0] - start[0]
+        self.events.append({
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": int((start[0] - self.epoch) * 1000000),
+            "dur": int(wall * 1000000),
+            "pid": self.pid,
+            "tid": self.pid,
+            "args": {
+                "cpu_s": round(end[1] - start[1], 6),
+                "children_cpu_s": round(end[2] - start[2], 6),
+                "spawned": end[3] - start[3],
+                },
+            })
+        stack = ";".join([frame[0] for frame in self.stack] + [name])
+        self.folded[stack] = self.folded.get(stack, 0) + int(max(wall - inner, 0) * 1000000)
+        if self.stack:
+            self.stack[-1][3] += wall
+
+    def call(self, name, func, category="hook"):
+        self.push(name, category)
+        try:
+            return func()
+        finally:
+            self.pop()
+
+    decorate(traceLog())
+    def write(self, resultdir):
+        """write profile.json and profile.folded to resultdir. Frames still
+           open, like the ones of a failed run, end now."""
+        while self.stack:
+            self.pop()
+        events = sorted(self.events, key=lambda event: event["ts"])
+        f = open(os.path.join(resultdir, "profile.json"), "w")
+        try:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f, indent=1)
+        finally:
+            f.close()
+        f = open(os.path.join(resultdir, "profile.folded"), "w")
+        try:
+            for stack in sorted(self.folded.keys()):
+                f.write("%s %d\n" % (stack, self.folded[stack]))
+        finally:
+            f.close()
+        getLog().info("profile written to %s/profile.json and profile.folded" % resultdir)
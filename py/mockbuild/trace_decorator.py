@@ -37,43 +37,60 @@ def doLog(logger, level, *args, **kargs):
             del(kargs["func"])
             logger.handle(logger.makeRecord(logger.name, level, *args, **kargs))
 
+# whether traceLog() wraps functions at all. It is looked at when they are
+# decorated, so set it before importing the modules to trace: with it off
+# they are left as they are and cost nothing extra to call.
+tracing = True
+
+class _EnterMessage(object):
+    """the ENTER message of a traced call, the arguments are only formatted
+       when it is actually logged"""
+    def __init__(self, func_name, args, kw):
+        self.func_name = func_name
+        self.args = args
+        self.kw = kw
+
+    def __str__(self):
+        message = "ENTER %s(" % self.func_name
+        for arg in self.args:
+            message = message + repr(arg) + ", "
+        for k,v in self.kw.items():
+            message = message + "%s=%s" % (k,repr(v))
+        return message + ")"
+
 def traceLog(log = None):
     def decorator(func):
+        if not tracing:
+            return func
+
+        filename = os.path.normcase(func.func_code.co_filename)
+        func_name = func.func_code.co_name
+        lineno = func.func_code.co_firstlineno
+
         def trace(*args, **kw):
             # default to logger that was passed by module, but
             # can override by passing logger=foo as function parameter.
             # make sure this doesn't conflict with one of the parameters
             # you are expecting
 
-            filename = os.path.normcase(func.func_code.co_filename)
-            func_name = func.func_code.co_name
-            lineno = func.func_code.co_firstlineno
-
             l2 = kw.get('logger', log)
             if l2 is None:
                 l2 = logging.getLogger("trace.%s" % func.__module__)
             if isinstance(l2, basestring):
                 l2 = logging.getLogger(l2)
 
-            message = "ENTER %s(" % func_name
-            for arg in args:
-                message = message + repr(arg) + ", "
-            for k,v in kw.items():
-                message = message + "%s=%s" % (k,repr(v))
-            message = message + ")"
-
             frame = sys._getframe(2)
-            doLog(l2, logging.INFO, os.path.normcase(frame.f_code.co_filename), frame.f_lineno, message, args=[], exc_info=None, func=frame.f_code.co_name)
+            doLog(l2, logging.INFO, os.path.normcase(frame.f_code.co_filename), frame.f_lineno, _EnterMessage(func_name, args, kw), args=[], exc_info=None, func=frame.f_code.co_name)
             try:
                 result = "Bad exception raised: Exception was not a derived class of 'Exception'"
                 try:
                     result = func(*args, **kw)
                 except (KeyboardInterrupt, Exception), e:
                     result = "EXCEPTION RAISED"
-                    doLog(l2, logging.INFO, filename, lineno, "EXCEPTION: %s\n" % e, args=[], exc_info=sys.exc_info(), func=func_name)
+                    doLog(l2, logging.INFO, filename, lineno, "EXCEPTION: %s\n", args=(e,), exc_info=sys.exc_info(), func=func_name)
                     raise
             finally:
-                doLog(l2, logging.INFO, filename, lineno, "LEAVE %s --> %s\n" % (func_name, result), args=[], exc_info=None, func=func_name)
+                doLog(l2, logging.INFO, filename, lineno, "LEAVE %s --> %s\n", args=(func_name, result), exc_info=None, func=func_name)
 
             return result
         return rewrap(func, trace)
@@ -6,6 +6,7 @@
 # Copyright (C) 2007 Michael E Brown <mebrown@michaels-house.net>
 
 # python library imports
+import collections
 import ctypes
 import fcntl
 import os
@@ -15,10 +16,14 @@ import rpmUtils
 import rpmUtils.transaction
 import select
 import shutil
+import signal
 import subprocess
+import tempfile
+import threading
 import time
 import errno
 import grp
+import logging
 from glob import glob
 from ast import literal_eval
 
@@ -184,6 +189,18 @@ def getAddtlReqs(hdr, conf):
 
     return rpmUtils.miscutils.unique(reqlist)
 
+decorate(traceLog())
+def getBuildReqs(hdr):
+    """the BuildRequires of an srpm, like yum resolvedep takes them"""
+    reqlist = []
+    for (name, flags, ver) in zip(hdr[rpm.RPMTAG_REQUIRENAME],
+                                  hdr[rpm.RPMTAG_REQUIREFLAGS],
+                                  hdr[rpm.RPMTAG_REQUIREVERSION]):
+        if name.startswith('rpmlib('):
+            continue
+        reqlist.append(rpmUtils.miscutils.formatRequire(name, ver, flags))
+    return rpmUtils.miscutils.unique(reqlist)
+
 # not traced...
 def chomp(line):
     if line.endswith("\n"):
@@ -237,40 +254,194 @@ def condEnvironment(env=None):
     for k in env.keys():
         os.putenv(k, env[k])
 
-def logOutput(fds, logger, returnOutput=1, start=0, timeout=0, printOutput=False, child=None, chrootPath=None):
-    output=""
-    done = 0
+# children exiting wake up the main thread through this pipe: the SIGCHLD
+# handler writes to it, so it can be select()ed on next to their output
+_mainThread = threading.currentThread()
+_sigchldFd = None
+
+def _sigchldHandler(signum, frame):
+    pass
+
+def _childWakeupFd():
+    """the fd that gets readable when a child exits, or None when that can
+       not be used because this is not the main thread"""
+    global _sigchldFd
+    if threading.currentThread() is not _mainThread:
+        return None
+    if _sigchldFd is None:
+        r, w = os.pipe()
+        for fd in (r, w):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+            fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+        signal.signal(signal.SIGCHLD, _sigchldHandler)
+        # only select() should return early, other system calls are restarted
+        signal.siginterrupt(signal.SIGCHLD, False)
+        signal.set_wakeup_fd(w)
+        _sigchldFd = r
+    return _sigchldFd
+
+def _waitReadable(fds, deadline, wakeup):
+    """wait until one of fds is readable, a child exits or deadline (a
+       time.time(), None for none) passes. returns the readable ones of fds"""
+    rfds = list(fds)
+    wait = None
+    if wakeup is not None:
+        rfds.append(wakeup)
+    else:
+        # no wakeup on exits, look at the child now and then
+        wait = 0.1
+    if deadline is not None:
+        left = max(0, deadline - time.time())
+        if wait is None or left < wait:
+            wait = left
+    try:
+        ready = select.select(rfds, [], [], wait)[0]
+    except select.error, e:
+        if e.args[0] != errno.EINTR:
+            raise
+        ready = []
+    if wakeup is not None and wakeup in ready:
+        ready.remove(wakeup)
+        try:
+            while os.read(wakeup, 4096):
+                pass
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+    return ready
+
+def _readChunk(fd):
+    """what can be read from fd right now: "" at EOF, None if nothing"""
+    try:
+        return os.read(fd.fileno(), 65536)
+    except OSError, e:
+        if e.errno != errno.EAGAIN:
+            raise
+        return None
+
+class BufferedFileHandler(logging.FileHandler):
+    """a FileHandler for logs that get a lot of lines, like build.log: the
+       file is written when bufferSize bytes are buffered, and flushed at
+       most every flushInterval seconds instead of after every record.
+       flushLogs() writes out the rest."""
+    def __init__(self, filename, mode='a', bufferSize=64*1024, flushInterval=1.0):
+        self.bufferSize = bufferSize
+        self.flushInterval = flushInterval
+        self.lastFlush = time.time()
+        logging.FileHandler.__init__(self, filename, mode)
+
+    def _open(self):
+        return open(self.baseFilename, self.mode, self.bufferSize)
+
+    def flush(self, force=False):
+        # emit() calls this after every record
+        now = time.time()
+        if force or now - self.lastFlush >= self.flushInterval:
+            self.lastFlush = now
+            logging.FileHandler.flush(self)
+
+def flushLogs(logger):
+    """write out what the BufferedFileHandlers the records of logger go to
+       still buffer"""
+    while logger is not None:
+        for h in logger.handlers:
+            if isinstance(h, BufferedFileHandler):
+                h.flush(force=True)
+        if not logger.propagate:
+            break
+        logger = logger.parent
+
+class OutputBuffer(object):
+    """collects the output of a command as a list of chunks, which is moved
+       to a temporary file once it gets bigger than maxMemory bytes, so
+       only that much of it is held in memory while the command runs"""
+    def __init__(self, maxMemory=None):
+        self.maxMemory = maxMemory
+        self.chunks = []
+        self.size = 0
+        self.spill = None
+
+    def write(self, data):
+        self.size += len(data)
+        if self.spill is not None:
+            self.spill.write(data)
+            return
+        self.chunks.append(data)
+        if self.maxMemory is not None and self.size > self.maxMemory:
+            self.spill = tempfile.TemporaryFile(prefix="mock-output-")
+            self.spill.writelines(self.chunks)
+            self.chunks = []
+
+    def getvalue(self):
+        """all of the output"""
+        if self.spill is None:
+            return "".join(self.chunks)
+        self.spill.seek(0)
+        try:
+            return self.spill.read()
+        finally:
+            self.spill.seek(0, 2)
+
+    def close(self):
+        if self.spill is not None:
+            self.spill.close()
+            self.spill = None
+        self.chunks = []
+
+def logOutput(fds, logger, returnOutput=1, start=0, timeout=0, printOutput=False, child=None, chrootPath=None,
+              lineCallback=None, maxMemory=None, lastLines=None):
+    """log what is written to fds until they are all closed, the child exits
+       or the timeout passes. Each complete line is passed to lineCallback
+       as it comes in, and appended to lastLines (a bounded deque, for
+       error messages). The output is returned if returnOutput, kept in
+       memory up to maxMemory bytes and in a temporary file past that."""
+    output = OutputBuffer(maxMemory)
+    deadline = None
+    if timeout:
+        deadline = start + timeout
+    wakeup = None
+    if child is not None:
+        wakeup = _childWakeupFd()
 
     # set all fds to nonblocking
+    fds = [fd for fd in fds if not fd.closed]
     for fd in fds:
         flags = fcntl.fcntl(fd, fcntl.F_GETFL)
-        if not fd.closed:
-            fcntl.fcntl(fd, fcntl.F_SETFL, flags| os.O_NONBLOCK)
+        fcntl.fcntl(fd, fcntl.F_SETFL, flags| os.O_NONBLOCK)
 
     tail = ""
-    while not done:
-        if (time.time() - start)>timeout and timeout!=0:
-            done = 1
+    unflushed = False
+    while fds:
+        if deadline is not None and time.time() >= deadline:
             break
 
-        i_rdy,o_rdy,e_rdy = select.select(fds,[],[],1)
-
-        if not i_rdy and not o_rdy and not e_rdy:
-            if child and child.poll() is not None:
-                logger.info("Child pid '%s' is dead" % child.pid)
-                done = True
-                if chrootPath:
-                    logger.info("Child dead, killing orphans")
-                    orphansKill(chrootPath)
-                continue
+        # what the child wrote before it exited is still read, but not
+        # waited for: anything keeping the fds open after it is an orphan
+        exited = child is not None and child.poll() is not None
+        if exited:
+            ready = list(fds)
+        elif unflushed:
+            # logged lines are flushed once the output pauses for a moment
+            wait = time.time() + 0.2
+            if deadline is not None and deadline < wait:
+                wait = deadline
+            ready = _waitReadable(fds, wait, wakeup)
+            if not ready:
+                flushLogs(logger)
+                unflushed = False
+        else:
+            ready = _waitReadable(fds, deadline, wakeup)
 
-        for s in i_rdy:
-            # slurp as much input as is ready
-            input = s.read()
+        idle = 0
+        for s in ready:
+            input = _readChunk(s)
             if input == "":
-                done = 1
-                break
-            if logger is not None:
+                fds.remove(s)
+                continue
+            if input is None:
+                idle += 1
+                continue
+            if logger is not None or lineCallback is not None or lastLines is not None:
                 lines = input.split("\n")
                 if tail:
                     lines[0] = tail + lines[0]
@@ -278,17 +449,36 @@ def logOutput(fds, logger, returnOutput=1, start=0, timeout=0, printOutput=False
                 tail = lines.pop()
                 for line in lines:
                     if line == '': continue
-                    logger.debug(line)
-                for h in logger.handlers:
-                    h.flush()
+                    if logger is not None:
+                        logger.debug(line)
+                    if lineCallback is not None:
+                        lineCallback(line)
+                    if lastLines is not None:
+                        lastLines.append(line)
+                unflushed = logger is not None
             if returnOutput:
-                output += input
+                output.write(input)
             if printOutput:
                 print input,
 
-    if tail and logger is not None:
-        logger.debug(tail)
-    return output
+        if exited and fds and idle == len(fds):
+            logger.info("Child pid '%s' is dead" % child.pid)
+            if chrootPath:
+                logger.info("Child dead, killing orphans")
+                orphansKill(chrootPath)
+            break
+
+    if tail:
+        if logger is not None:
+            logger.debug(tail)
+        if lineCallback is not None:
+            lineCallback(tail)
+        if lastLines is not None:
+            lastLines.append(tail)
+    try:
+        return output.getvalue()
+    finally:
+        output.close()
 
 decorate(traceLog())
 def selinuxEnabled():
@@ -309,19 +499,27 @@ def selinuxEnabled():
         pass
     return False
 
+# how many commands do() started, for the profiler
+spawnCount = 0
+
 # logger =
 # output = [1|0]
 # chrootPath
+# lineCallback = called with each line of output as it comes in
+# maxMemory = how much of the returned output to keep in memory
+# errorLines = how many of the last lines of output a failure reports
 #
 # The "Not-as-complicated" version
 #
 decorate(traceLog())
 def do(command, shell=False, chrootPath=None, cwd=None, timeout=0, raiseExc=True,
        returnOutput=0, uid=None, gid=None, personality=None,
-       printOutput=False, env=None, *args, **kargs):
+       printOutput=False, env=None, lineCallback=None, maxMemory=16*1024*1024,
+       errorLines=20, *args, **kargs):
 
     logger = kargs.get("logger", getLog())
     output = ""
+    lastLines = collections.deque(maxlen=errorLines)
     start = time.time()
     preexec = ChildPreExec(personality, chrootPath, cwd, uid, gid)
     if env is None:
@@ -329,6 +527,8 @@ def do(command, shell=False, chrootPath=None, cwd=None, timeout=0, raiseExc=True
     try:
         child = None
         logger.debug("Executing command: %s with env %s" % (command, env))
+        global spawnCount
+        spawnCount += 1
         child = subprocess.Popen(
             command,
             shell=shell,
@@ -340,11 +540,13 @@ def do(command, shell=False, chrootPath=None, cwd=None, timeout=0, raiseExc=True
             preexec_fn = preexec,
             )
 
-        # use select() to poll for output so we dont block
+        # log the output as it comes, see logOutput()
         output = logOutput([child.stdout, child.stderr],
-                           logger, returnOutput, start, timeout, printOutput=printOutput, child=child, chrootPath=chrootPath)
+                           logger, returnOutput, start, timeout, printOutput=printOutput, child=child, chrootPath=chrootPath,
+                           lineCallback=lineCallback, maxMemory=maxMemory, lastLines=lastLines)
 
     except:
+        flushLogs(logger)
         # kill children if they arent done
         if child is not None and child.returncode is None:
             os.killpg(child.pid, 9)
@@ -355,25 +557,34 @@ def do(command, shell=False, chrootPath=None, cwd=None, timeout=0, raiseExc=True
             pass
         raise
 
-    # wait until child is done, kill it if it passes timeout
+    # wait until child is done: past the timeout it gets a SIGTERM, and a
+    # second later a SIGKILL
     niceExit=1
+    kills = []
+    if timeout:
+        kills = [(start + timeout, 15), (start + timeout + 1, 9)]
+    wakeup = _childWakeupFd()
     while child.poll() is None:
-        if (time.time() - start)>timeout and timeout!=0:
-            niceExit=0
-            os.killpg(child.pid, 15)
-        if (time.time() - start)>(timeout+1) and timeout!=0:
+        if kills and time.time() >= kills[0][0]:
             niceExit=0
-            os.killpg(child.pid, 9)
+            os.killpg(child.pid, kills.pop(0)[1])
+            continue
+        deadline = None
+        if kills:
+            deadline = kills[0][0]
+        _waitReadable([], deadline, wakeup)
 
     if not niceExit:
-        raise commandTimeoutExpired, ("Timeout(%s) expired for command:\n # %s\n%s" % (timeout, command, output))
+        flushLogs(logger)
+        raise commandTimeoutExpired, ("Timeout(%s) expired for command:\n # %s\n%s" % (timeout, command, output or "\n".join(lastLines)))
 
     logger.debug("Child return code was: %s" % str(child.returncode))
     if raiseExc and child.returncode:
+        flushLogs(logger)
         if returnOutput:
             raise mockbuild.exception.Error, ("Command failed: \n # %s\n%s" % (command, output), child.returncode)
         else:
-            raise mockbuild.exception.Error, ("Command failed. See logs for output.\n # %s" % (command,), child.returncode)
+            raise mockbuild.exception.Error, ("Command failed. See logs for all of the output.\n # %s\n%s" % (command, "\n".join(lastLines)), child.returncode)
 
     return output
 
@@ -469,6 +680,7 @@ def setup_default_config_opts(unprivUid, version, pkgpythondir):
     config_opts['chroothome'] = '/builddir'
     config_opts['log_config_file'] = 'logging.ini'
     config_opts['rpmbuild_timeout'] = 0
+    config_opts['output_memory_limit'] = 16 * 1024 * 1024
     config_opts['chrootuid'] = unprivUid
     try:
         config_opts['chrootgid'] = grp.getgrnam("mock")[2]
@@ -500,7 +712,7 @@ def setup_default_config_opts(unprivUid, version, pkgpythondir):
     #    after that, any plugins that must create dirs (yum_cache)
     #    any plugins without preinit hooks should be last.
     config_opts['plugins'] = ['tmpfs', 'root_cache', 'yum_cache', 'bind_mount', 'ccache', 'selinux',
-                              'package_state', 'chroot_scan']
+                              'package_state', 'chroot_scan', 'build_cache']
     config_opts['plugin_dir'] = os.path.join(pkgpythondir, "plugins")
     config_opts['plugin_conf'] = {
             'ccache_enable': True,
@@ -512,16 +724,22 @@ def setup_default_config_opts(unprivUid, version, pkgpythondir):
             'yum_cache_opts': {
                 'max_age_days': 30,
                 'max_metadata_age_days': 30,
+                'prune_on_init': True,
                 'dir': "%(cache_topdir)s/%(root)s/yum_cache/",
+                'package_pool': False,
+                'package_pool_dir': "%(cache_topdir)s/package_pool/",
                 'online': True,},
             'root_cache_enable': True,
             'root_cache_opts': {
                 'age_check' : True,
                 'max_age_days': 15,
+                'update_threshold_hours': 0,
+                'deps_cache': False,
                 'dir': "%(cache_topdir)s/%(root)s/root_cache/",
                 'compress_program': 'pigz',
                 'exclude_dirs': ["./proc", "./sys", "./dev", "./tmp/ccache", "./var/cache/yum" ],
-                'extension': '.gz'},
+                'extension': '.gz',
+                'method': 'tar'},
             'bind_mount_enable': True,
             'bind_mount_opts': {
             	'dirs': [
@@ -549,6 +767,9 @@ def setup_default_config_opts(unprivUid, version, pkgpythondir):
                 "\\bcore(\\.\\d+)?$",
                 "\\.log$",
                 ]},
+            'build_cache_enable': False,
+            'build_cache_opts': {
+                'dir': "%(cache_topdir)s/%(root)s/build_cache/"},
             }
 
     config_opts['environment'] = {
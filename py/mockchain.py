@@ -18,7 +18,7 @@
 # SUMMARY
 # mockchain
 # take a mock config and a series of srpms
-# rebuild them one at a time
+# rebuild them one at a time (or several at once with --workers)
 # adding each to a local repo
 # so they are available as build deps to next pkg being built
 
@@ -30,8 +30,17 @@ import tempfile
 import shutil
 from urlgrabber import grabber
 import time
+import glob
+import threading
+import traceback
+import Queue
+import rpm
+import hashlib
+import sqlite3
+import re
 
 import mockbuild.util
+import mockbuild.exception
 
 # all of the variables below are substituted by the build system
 __VERSION__ = "unreleased_version"
@@ -43,11 +52,20 @@ MOCKCONFDIR = os.path.join(SYSCONFDIR, "mock")
 
 mockconfig_path='/etc/mock'
 
-def createrepo(path):
+def createrepo(path, cachedir=None, skip_stat=False):
+    comm = ['/usr/bin/createrepo']
     if os.path.exists(path + '/repodata/repomd.xml'):
-        comm = ['/usr/bin/createrepo', '--update', path]
-    else:
-        comm = ['/usr/bin/createrepo', path]
+        # reuse the entries of the rpms already in the repodata whose size
+        # and mtime did not change, so only new or rebuilt rpms get their
+        # headers read. With skip_stat the entries are reused without
+        # looking at the files at all, which is only right when no rpm
+        # the repodata has was written again.
+        comm += ['--update']
+        if skip_stat:
+            comm += ['--skip-stat']
+    if cachedir:
+        comm += ['--cachedir', cachedir]
+    comm.append(path)
     cmd = subprocess.Popen(comm,
              stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     out, err = cmd.communicate()
@@ -67,10 +85,31 @@ def parse_args(args):
             help="add these repo baseurls to the chroot's yum config")
     parser.add_option('--recurse', default=False, action='store_true',
             help="if more than one pkg and it fails to build, try to build the rest and come back to it")
+    parser.add_option('--rpmbuild_timeout', default=None, type='int',
+            dest='rpmbuild_timeout',
+            help="passed on to mock. with --recurse a pkg which timed out is"
+                 " tried again with twice the timeout")
     parser.add_option('--log', default=None, dest='logfile',
             help="log to the file named by this option, defaults to not logging")
     parser.add_option('--tmp_prefix', default=None, dest='tmp_prefix',
             help="tmp dir prefix - will default to username-pid if not specified")
+    parser.add_option('-w', '--workers', default=1, type='int',
+            help="number of pkgs to build at the same time, each in its own chroot."
+                 " pkgs are started as soon as the pkgs they buildrequire are built")
+    parser.add_option('--fetchers', default=4, type='int',
+            help="number of http(s) srpm urls to download at the same time,"
+                 " default is 4")
+    parser.add_option('--tail', default=False, action='store_true',
+            help="show the output of the builds as it comes, each line prefixed"
+                 " with the pkg it belongs to")
+    parser.add_option('--reuse-mock', default=False, action='store_true',
+            dest='reuse_mock',
+            help="keep one mock process running per worker (mock --batch) instead"
+                 " of starting mock for each pkg")
+    parser.add_option('--batch-createrepo', default=False, action='store_true',
+            dest='batch_createrepo',
+            help="update the local repo once for all the pkgs which finished"
+                 " building meanwhile instead of after each one")
 
 
     #FIXME?
@@ -80,6 +119,14 @@ def parse_args(args):
     if opts.recurse:
         opts.cont = True
 
+    if opts.workers < 1:
+        print "--workers must be at least 1"
+        sys.exit(1)
+
+    if opts.fetchers < 1:
+        print "--fetchers must be at least 1"
+        sys.exit(1)
+
     if not opts.chroot:
         print "You must provide an argument to -r for the mock chroot"
         sys.exit(1)
@@ -124,16 +171,126 @@ cost=1
 
     return True, ''
 
-def do_build(opts, cfg, pkg):
+def update_local_repo(opts):
+    """createrepo the local repo after builds. The rpms in the result dirs
+       of the pkgs built or tried since the last time are the only ones
+       that may have changed, so unless one of them is in the repodata
+       already (e.g. the srpm of a pkg tried again) the others are not
+       stat'ed"""
+    touched = set()
+    for pkg in opts.repo_touched:
+        touched.update(glob.glob(pkg_resdir(opts, pkg) + '/*.rpm'))
+    out, err = createrepo(opts.local_repo_dir, opts.repo_cache_dir,
+                          skip_stat=not touched & opts.repo_rpms)
+    opts.repo_rpms.update(touched)
+    opts.repo_touched = set()
+    return out, err
+
+def pkg_resdir(opts, pkg):
+    pdn = os.path.basename(pkg).replace('.src.rpm', '')
+    return os.path.normpath('%s/%s' % (opts.local_repo_dir, pdn))
+
+# keeps lines from different builds from getting mixed up on the terminal
+print_lock = threading.Lock()
+
+class BuildOutput(object):
+    """writes the output of a build to its mockchain.log as it comes and,
+       with --tail, to stdout prefixed with the pkg name"""
+    def __init__(self, opts, pkg, resdir):
+        self.logfile = open(resdir + '/mockchain.log', 'w')
+        self.tail = opts.tail
+        self.prefix = '[%s] ' % os.path.basename(pkg).replace('.src.rpm', '')
+        self.partial = ''
+
+    def write(self, data):
+        self.logfile.write(data)
+        if not self.tail:
+            return
+        lines = (self.partial + data).split('\n')
+        self.partial = lines.pop()
+        # don't hold on to a never ending line
+        if len(self.partial) > 65536:
+            lines.append(self.partial)
+            self.partial = ''
+        if lines:
+            print_lock.acquire()
+            try:
+                for line in lines:
+                    sys.stdout.write(self.prefix + line + '\n')
+                sys.stdout.flush()
+            finally:
+                print_lock.release()
+
+    def close(self):
+        if self.partial:
+            self.write('\n')
+        self.logfile.close()
+
+
+class MockSession(object):
+    """a mock --batch process building one pkg after the other in the
+       same chroot, so the configs and plugins are only set up once"""
+    def __init__(self, opts, cfg, uniqueext):
+        self.mockcmd = ['/usr/bin/mock',
+                        '--configdir', opts.config_path,
+                        '--uniqueext', uniqueext,
+                        '-r', cfg, '--batch']
+        self.proc = None
+        self.returncode = None
+
+    def build(self, pkg, resdir, timeout, output):
+        """the output of mock is written to output"""
+        if self.proc is None:
+            self.proc = subprocess.Popen(self.mockcmd,
+                    stdin=subprocess.PIPE,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.STDOUT)
+        self.returncode = 1
+        try:
+            if timeout is None:
+                self.proc.stdin.write('%s\t%s\n' % (pkg, resdir))
+            else:
+                self.proc.stdin.write('%s\t%s\t%d\n' % (pkg, resdir, timeout))
+            self.proc.stdin.flush()
+        except IOError:
+            pass
+        for line in iter(self.proc.stdout.readline, ''):
+            if line.startswith('mock-batch: '):
+                self.returncode = int(line.split()[1])
+                return
+            output.write(line)
+        # mock went away, start a new one for the next pkg
+        self.proc.wait()
+        self.proc = None
+
+    def close(self):
+        if self.proc is not None:
+            self.proc.stdin.close()
+            self.proc.wait()
+            self.proc = None
+
+
+# one per worker chroot, keyed by uniqueext
+mock_sessions = {}
+
+def mock_session(opts, cfg, uniqueext):
+    if uniqueext not in mock_sessions:
+        mock_sessions[uniqueext] = MockSession(opts, cfg, uniqueext)
+    return mock_sessions[uniqueext]
+
 
-    # returns 0, cmd, out, err = failure
-    # returns 1, cmd, out, err  = success
-    # returns 2, None, None, None = already built
+def do_build(opts, cfg, pkg, uniqueext=None):
+
+    # returns 0, cmd = failure, see classify_failure()
+    # returns 1, cmd = success
+    # returns 2, None = already built
+    # the output of mock is in mockchain.log in the pkg's result dir
+
+    if uniqueext is None:
+        uniqueext = opts.uniqueext
 
     s_pkg = os.path.basename(pkg)
-    pdn = s_pkg.replace('.src.rpm', '')
-    resdir = '%s/%s' % (opts.local_repo_dir, pdn)
-    resdir = os.path.normpath(resdir)
+    resdir = pkg_resdir(opts, pkg)
     if not os.path.exists(resdir):
         os.makedirs(resdir)
 
@@ -141,23 +298,45 @@ def do_build(opts, cfg, pkg):
     fail_file = resdir + '/fail'
 
     if os.path.exists(success_file):
-        return 2, None, None, None
+        return 2, None
 
     # clean it up if we're starting over :)
     if os.path.exists(fail_file):
         os.unlink(fail_file)
 
-    mockcmd = ['/usr/bin/mock',
-               '--configdir', opts.config_path,
-               '--resultdir', resdir,
-               '--uniqueext', opts.uniqueext,
-               '-r', cfg, ]
+    # where this build starts in the build.log mock appends to
+    try:
+        opts.build_log_starts[pkg] = os.path.getsize(resdir + '/build.log')
+    except OSError:
+        opts.build_log_starts[pkg] = 0
+
     print 'building %s' % s_pkg
-    mockcmd.append(pkg)
-    cmd = subprocess.Popen(mockcmd,
-           stdout=subprocess.PIPE,
-           stderr=subprocess.PIPE )
-    out, err = cmd.communicate()
+    timeout = opts.timeouts.get(pkg, opts.rpmbuild_timeout)
+    output = BuildOutput(opts, pkg, resdir)
+    try:
+        if opts.reuse_mock:
+            cmd = mock_session(opts, cfg, uniqueext)
+            cmd.build(pkg, resdir, timeout, output)
+        else:
+            mockcmd = ['/usr/bin/mock',
+                       '--configdir', opts.config_path,
+                       '--resultdir', resdir,
+                       '--uniqueext', uniqueext,
+                       '-r', cfg, ]
+            if timeout is not None:
+                mockcmd.extend(['--rpmbuild_timeout', str(timeout)])
+            mockcmd.append(pkg)
+            cmd = subprocess.Popen(mockcmd,
+                   stdout=subprocess.PIPE,
+                   stderr=subprocess.STDOUT )
+            while True:
+                data = os.read(cmd.stdout.fileno(), 65536)
+                if not data:
+                    break
+                output.write(data)
+            cmd.wait()
+    finally:
+        output.close()
     if cmd.returncode == 0:
         open(success_file, 'w').write('done\n')
         ret = 1
@@ -165,7 +344,7 @@ def do_build(opts, cfg, pkg):
         open(fail_file, 'w').write('undone\n')
         ret = 0
 
-    return ret, cmd, out, err
+    return ret, cmd
 
 
 def log(lf, msg):
@@ -178,6 +357,607 @@ def log(lf, msg):
     print msg
 
 
+def fetch_pkg(lf, ug, url, cache_dir):
+    """download url with the URLGrabber ug unless it is in cache_dir already,
+       returns the local path or None"""
+    # one dir per url. the checksum stored next to the srpm tells a
+    # complete download from one that got cut short
+    pkg_dir = os.path.join(cache_dir, hashlib.sha1(url).hexdigest())
+    pkg = os.path.join(pkg_dir, os.path.basename(url))
+    sum_file = pkg_dir + '/sha256'
+    if os.path.exists(pkg) and os.path.exists(sum_file):
+        if open(sum_file).read().strip() == file_checksum(pkg):
+            log(lf, 'Using cached %s' % url)
+            return pkg
+    if not os.path.exists(pkg_dir):
+        os.makedirs(pkg_dir)
+    try:
+        log(lf, 'Fetching %s' % url)
+        ug.urlgrab(url, filename=pkg + '.part')
+        os.rename(pkg + '.part', pkg)
+        open(sum_file, 'w').write(file_checksum(pkg) + '\n')
+        return pkg
+    except Exception, e:
+        log(lf, 'Error Downloading %s: %s' % (url, str(e)))
+        if os.path.exists(pkg + '.part'):
+            os.unlink(pkg + '.part')
+        return None
+
+
+def fetch_pkgs(opts, urls, cache_dir):
+    """download urls opts.fetchers at a time, returns {url: local path or None}"""
+    todo = Queue.Queue()
+    for url in urls:
+        todo.put(url)
+    fetched = {}
+
+    def fetcher():
+        # a grabber per thread, so each keeps its connections alive
+        ug = grabber.URLGrabber(keepalive=1)
+        while True:
+            try:
+                url = todo.get_nowait()
+            except Queue.Empty:
+                return
+            fetched[url] = fetch_pkg(opts.logfile, ug, url, cache_dir)
+
+    threads = []
+    for num in range(min(opts.fetchers, len(urls))):
+        t = threading.Thread(target=fetcher)
+        t.setDaemon(True)
+        t.start()
+        threads.append(t)
+    for t in threads:
+        # a plain join() would not notice ^C
+        while t.isAlive():
+            t.join(1)
+    return fetched
+
+
+def file_checksum(path):
+    csum = hashlib.sha256()
+    f = open(path, 'rb')
+    try:
+        while True:
+            data = f.read(1024 * 1024)
+            if not data:
+                break
+            csum.update(data)
+    finally:
+        f.close()
+    return csum.hexdigest()
+
+
+package_re = re.compile(r'^%package\s+(.*)$')
+provides_re = re.compile(r'^Provides:\s*(.*)$', re.I)
+name_macro_re = re.compile(r'%\{name\}|%name\b')
+
+def spec_provides(name, spec):
+    """the names and provides of the binary pkgs the spec text makes, as far
+       as can be told without building it: %package lines and Provides:.
+       The spec is not run through rpm here, on the host: expanding its
+       macros could run its shell and lua code. So besides %{name} only
+       literal names are taken, the ones using other macros are left out.
+       %if is not looked at, so it may be more than one build really
+       provides."""
+    provides = set([name])
+    def literal(text):
+        text = name_macro_re.sub(name, text)
+        if '%' in text:
+            return None
+        return text
+    for line in spec.split('\n'):
+        line = line.strip()
+        m = package_re.match(line)
+        if m:
+            args = m.group(1).split()
+            if '-n' in args[:-1]:
+                binary = literal(args[args.index('-n') + 1])
+            elif args:
+                binary = literal("%s-%s" % (name, args[0]))
+            else:
+                binary = None
+            if binary:
+                provides.add(binary)
+            continue
+        m = provides_re.match(line)
+        if m:
+            for prov in m.group(1).split(','):
+                prov = prov.split()
+                if prov and literal(prov[0]):
+                    provides.add(literal(prov[0]))
+    return provides
+
+def read_spec(pkg, hdr):
+    """the text of the spec in srpm pkg, '' if there is none"""
+    specs = [f for f in hdr[rpm.RPMTAG_BASENAMES] or [] if f.endswith('.spec')]
+    if not specs:
+        return ''
+    rpm2cpio = subprocess.Popen(['rpm2cpio', pkg], stdout=subprocess.PIPE)
+    cpio = subprocess.Popen(['cpio', '-i', '--quiet', '--to-stdout', specs[0]],
+            stdin=rpm2cpio.stdout, stdout=subprocess.PIPE)
+    rpm2cpio.stdout.close()
+    spec = cpio.communicate()[0]
+    rpm2cpio.wait()
+    return spec
+
+def read_pkg_info(opts, pkgs):
+    """read each srpm header once, returns
+       {pkg: (name, buildreqs, nevra, sha256 of the srpm, what it provides)}.
+       pkgs which can not be read are logged and left out."""
+    info = {}
+    for pkg in pkgs:
+        try:
+            hdr = mockbuild.util.yieldSrpmHeaders([pkg]).next()
+        except mockbuild.exception.Error, e:
+            log(opts.logfile, "Error: %s" % e)
+            continue
+        reqs = [r for r in hdr[rpm.RPMTAG_REQUIRENAME] if not r.startswith('rpmlib(')]
+        epoch = ''
+        if hdr[rpm.RPMTAG_EPOCH] is not None:
+            epoch = '%s:' % hdr[rpm.RPMTAG_EPOCH]
+        nevra = '%s-%s%s-%s.src' % (hdr[rpm.RPMTAG_NAME], epoch,
+                hdr[rpm.RPMTAG_VERSION], hdr[rpm.RPMTAG_RELEASE])
+        try:
+            provides = spec_provides(hdr[rpm.RPMTAG_NAME], read_spec(pkg, hdr))
+        except (Exception,), e:
+            log(opts.logfile, "Could not read the spec of %s, going by its header: %s" % (
+                os.path.basename(pkg), e))
+            provides = set([hdr[rpm.RPMTAG_NAME]])
+            provides.update(hdr[rpm.RPMTAG_PROVIDENAME] or [])
+        info[pkg] = (hdr[rpm.RPMTAG_NAME], set(reqs), nevra, file_checksum(pkg), provides)
+    return info
+
+
+def built_provides(opts, pkg):
+    """everything provided by the binary rpms built from pkg"""
+    rpms = [r for r in glob.glob(pkg_resdir(opts, pkg) + '/*.rpm')
+              if not r.endswith('.src.rpm')]
+    provides = set()
+    for hdr in mockbuild.util.yieldSrpmHeaders(rpms, plainRpmOk=1):
+        provides.update(hdr[rpm.RPMTAG_PROVIDENAME])
+    return provides
+
+
+# what mock and yum say when a pkg could not be built
+timeout_re = re.compile(r'Timeout\(\d+\) expired for command')
+# mock's error ends the name with a period: "No Package Found for foo."
+missing_req_res = [re.compile(r'No Package found for ([^\s,]+?)\.?(?:[\s,]|$)', re.I),
+                   re.compile(r'Missing Dependency: ([^\s,]+?)\.?(?:[\s,]|$)', re.I)]
+build_failed_res = [re.compile(r'^error: Bad exit status from'),
+                    re.compile(r'^RPM build errors:')]
+
+def classify_failure(resdir, build_log_start=0):
+    """look through the logs of a failed build to tell why it failed.
+       mock appends to build.log, the build is what comes after
+       build_log_start in it. returns (reason, missing buildreqs) where
+       reason is one of 'timeout', 'buildreq', 'build' or 'unknown'"""
+    def lines(name, start=0):
+        path = os.path.join(resdir, name)
+        if os.path.exists(path):
+            f = open(path)
+            try:
+                f.seek(start)
+                for line in f:
+                    yield line
+            finally:
+                f.close()
+
+    for line in lines('mockchain.log'):
+        if timeout_re.search(line):
+            return 'timeout', set()
+
+    # only the error mock failed with counts, from its last ERROR line on.
+    # root.log also has what the cache only resolvedep mock tries first
+    # did not find, even when it was found online after that.
+    error = None
+    for line in lines('mockchain.log'):
+        if line.startswith('ERROR'):
+            error = []
+        if error is not None:
+            error.append(line)
+    missing = set()
+    for line in error or []:
+        for regex in missing_req_res:
+            m = regex.search(line)
+            if m:
+                missing.add(m.group(1))
+    if missing:
+        return 'buildreq', missing
+
+    for line in lines('build.log', build_log_start):
+        for regex in build_failed_res:
+            if regex.search(line):
+                return 'build', set()
+    return 'unknown', set()
+
+
+class BuildLedger(object):
+    """what got built from which srpm with which config, kept in an sqlite
+       db in the local repo dir so later runs can skip finished pkgs and
+       know how long each pkg takes. Only to be used from the main thread."""
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS builds (
+                             id INTEGER PRIMARY KEY,
+                             name TEXT, nevra TEXT,
+                             srpm_sha256 TEXT, config_hash TEXT,
+                             outcome TEXT, started REAL, duration REAL,
+                             rpms TEXT)""")
+        self.db.execute("""CREATE INDEX IF NOT EXISTS builds_input
+                           ON builds (srpm_sha256, config_hash)""")
+        self.db.commit()
+
+    def succeeded(self, srpm_sha256, config_hash):
+        """the file names of the rpms of the last build of this srpm with
+           this config if it was a success, else None"""
+        row = self.db.execute("""SELECT outcome, rpms FROM builds
+                                 WHERE srpm_sha256 = ? AND config_hash = ?
+                                 ORDER BY id DESC LIMIT 1""",
+                              (srpm_sha256, config_hash)).fetchone()
+        if row is None or row[0] != 'success':
+            return None
+        return (row[1] or '').split()
+
+    def durations(self):
+        """{name: seconds the last successful build of it took}"""
+        durations = {}
+        for name, duration in self.db.execute("""SELECT name, duration FROM builds
+                                                 WHERE outcome = 'success'
+                                                 AND duration IS NOT NULL
+                                                 ORDER BY id"""):
+            durations[name] = duration
+        return durations
+
+    def record(self, cp, config_hash, outcome, started, duration, rpms):
+        self.db.execute("""INSERT INTO builds (name, nevra, srpm_sha256,
+                             config_hash, outcome, started, duration, rpms)
+                           VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                        (cp.name, cp.nevra, cp.sha256, config_hash, outcome,
+                         started, duration, ' '.join(rpms)))
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+class ChainPkg(object):
+    """a pkg in the chain and the other pkgs in the chain it waits on"""
+    def __init__(self, pkg, name, requires, nevra=None, sha256=None, provides=None):
+        self.pkg = pkg
+        self.name = name
+        self.requires = requires
+        self.nevra = nevra
+        self.sha256 = sha256
+        # until it is built all we know is what its spec says
+        self.provides = provides or set([name])
+        # {ChainPkg: set of our buildreqs we expect it to provide}
+        self.waits_on = {}
+        self.ready = None
+        self.started = None
+
+    def may_provide(self, req):
+        return req in self.provides
+
+
+class BuildGraph(object):
+    """which pkgs of the chain need which others to be built first"""
+    def __init__(self, chain_pkgs):
+        self.pending = list(chain_pkgs)
+        for cp in chain_pkgs:
+            for req in cp.requires:
+                # the first pkg in the chain which provides it
+                for other in chain_pkgs:
+                    if other is not cp and other.may_provide(req):
+                        cp.waits_on.setdefault(other, set()).add(req)
+                        break
+
+    def ready(self):
+        """pending pkgs that wait on nothing, in chain order"""
+        return [cp for cp in self.pending if not cp.waits_on]
+
+    def take(self, cp):
+        self.pending.remove(cp)
+
+    def built(self, cp, provides):
+        """cp was built; provides is what its rpms really provide"""
+        cp.provides = provides
+        for other in self.pending:
+            for prov, reqs in other.waits_on.items():
+                # a req we pinned on some other pkg may turn out to be
+                # provided by this one, so check all of them
+                reqs.difference_update(provides)
+                if prov is cp or not reqs:
+                    del other.waits_on[prov]
+
+    def failed(self, cp):
+        """cp failed; drop and return the pending pkgs which need it"""
+        doomed = []
+        check = [cp]
+        while check:
+            bad = check.pop()
+            for other in self.pending[:]:
+                if bad in other.waits_on:
+                    self.pending.remove(other)
+                    doomed.append(other)
+                    check.append(other)
+        return doomed
+
+    def order(self):
+        """returns the pending pkgs in a build order and the dependency
+           loops among them. pkgs stuck behind a loop go last, in the
+           order given"""
+        order = []
+        placed = set()
+        left = list(self.pending)
+        progress = True
+        while progress:
+            progress = False
+            for cp in left[:]:
+                if placed.issuperset(cp.waits_on):
+                    order.append(cp)
+                    placed.add(cp)
+                    left.remove(cp)
+                    progress = True
+
+        loops = []
+        seen = set()
+        for cp in left:
+            # whatever is left waits on something else that is left, so
+            # following that around must end up going in circles
+            path = []
+            while cp not in path and cp not in seen:
+                path.append(cp)
+                cp = [dep for dep in left if dep in cp.waits_on][0]
+            if cp in path:
+                loops.append(path[path.index(cp):])
+            seen.update(path)
+        return order + left, loops
+
+
+def order_pkgs(opts, pkgs, pkg_info):
+    """sort pkgs so that each comes after the pkgs it buildrequires. dependency
+       loops are reported here, before any chroot gets created"""
+    graph = BuildGraph([ChainPkg(pkg, *pkg_info[pkg]) for pkg in pkgs])
+    order, loops = graph.order()
+    for loop in loops:
+        log(opts.logfile, "Dependency loop: %s" % " -> ".join(
+            [cp.name for cp in loop + loop[:1]]))
+    if loops and not opts.cont:
+        log(opts.logfile, "Error: cannot order the pkgs, use -c to build them anyway")
+        sys.exit(1)
+    log(opts.logfile, "Build order: %s" % " ".join([os.path.basename(cp.pkg) for cp in order]))
+    return [cp.pkg for cp in order]
+
+
+def built_before(opts, cp):
+    """may cp be skipped: the ledger has its last build as a success, and
+       its 'success' file (removed to force a rebuild) and its rpms are
+       still in its result dir"""
+    rpms = opts.ledger.succeeded(cp.sha256, opts.config_hash)
+    if not rpms:
+        return False
+    resdir = pkg_resdir(opts, cp.pkg)
+    success_file = resdir + '/success'
+    if not os.path.exists(success_file):
+        return False
+    for name in rpms:
+        if not os.path.exists(os.path.join(resdir, name)):
+            # or do_build() would go by the 'success' file alone
+            log(opts.logfile, "%s of %s is gone, building it again" % (name, os.path.basename(cp.pkg)))
+            os.unlink(success_file)
+            return False
+    return True
+
+
+def build_round(opts, cfg, pkgs, pkg_info, built_pkgs):
+    """build pkgs using opts.workers chroots at once. A pkg is handed to a
+       worker as soon as the pkgs it buildrequires are in the local repo.
+       returns the list of pkgs which did not get built and
+       {pkg not built: the failed pkg it needed}"""
+    chain_pkgs = [ChainPkg(pkg, *pkg_info[pkg]) for pkg in pkgs]
+    graph = BuildGraph(chain_pkgs)
+    todo = Queue.Queue()
+    done = Queue.Queue()
+
+    def worker(num):
+        # each worker has a chroot of its own
+        uniqueext = '%s-%d' % (opts.uniqueext, num)
+        while True:
+            cp = todo.get()
+            if cp is None:
+                return
+            # the main loop waits for a result for every pkg it hands out,
+            # so there is one even when the build blew up
+            ret = 0
+            try:
+                try:
+                    ret = do_build(opts, cfg, cp.pkg, uniqueext)[0]
+                except (Exception,), e:
+                    log(opts.logfile, "Error building %s: %s" % (
+                        os.path.basename(cp.pkg), traceback.format_exc()))
+            finally:
+                done.put((cp, ret, time.time()))
+
+    threads = []
+    for num in range(opts.workers):
+        t = threading.Thread(target=worker, args=(num,))
+        t.setDaemon(True)
+        t.start()
+        threads.append(t)
+
+    failed = []
+    blocked = {}
+    running = 0
+    stop = False
+    start = time.time()
+    durations = opts.ledger.durations()
+    while True:
+        now = time.time()
+        ready = graph.ready()
+        done_before = [cp for cp in ready if built_before(opts, cp)]
+        if done_before:
+            for cp in done_before:
+                graph.take(cp)
+                log(opts.logfile, "Skipping already built pkg %s" % os.path.basename(cp.pkg))
+                graph.built(cp, built_provides(opts, cp.pkg))
+            continue
+        # the ones which took longest last time go first, the others in
+        # chain order
+        ready.sort(key=lambda cp: -durations.get(cp.name, 0))
+        if not ready and not running and graph.pending and not stop:
+            # everything left waits on something else that is left, so we
+            # guessed wrong or there is a loop. go on in the order given.
+            cp = graph.pending[0]
+            log(opts.logfile, "No pkg has its buildreqs built, trying %s anyway" % os.path.basename(cp.pkg))
+            cp.waits_on = {}
+            ready = [cp]
+        for cp in ready:
+            if cp.ready is None:
+                cp.ready = now
+        if not stop:
+            for cp in ready[:opts.workers - running]:
+                graph.take(cp)
+                cp.started = now
+                log(opts.logfile, "Start build: %s" % cp.pkg)
+                todo.put(cp)
+                running += 1
+        if not running:
+            break
+
+        # a plain get() would not notice ^C
+        results = [done.get(True, 86400 * 365)]
+        if opts.batch_createrepo:
+            while True:
+                try:
+                    results.append(done.get_nowait())
+                except Queue.Empty:
+                    break
+        new_rpms = []
+        for cp, ret, finished in results:
+            running -= 1
+            if ret != 2:
+                opts.repo_touched.add(cp.pkg)
+            rpms = [os.path.basename(r) for r in glob.glob(pkg_resdir(opts, cp.pkg) + '/*.rpm')]
+            if ret == 0:
+                opts.ledger.record(cp, opts.config_hash, 'fail', cp.started, finished - cp.started, rpms)
+            elif ret == 1:
+                opts.ledger.record(cp, opts.config_hash, 'success', cp.started, finished - cp.started, rpms)
+            elif ret == 2:
+                # built by a run which had no ledger yet
+                opts.ledger.record(cp, opts.config_hash, 'success', None, None, rpms)
+            log(opts.logfile, "End build: %s" % cp.pkg)
+            log(opts.logfile, "Times for %s: waited %ds on buildreqs, %ds for a worker, built in %ds" % (
+                os.path.basename(cp.pkg), cp.ready - start, cp.started - cp.ready, finished - cp.started))
+            if ret == 0:
+                failed.append(cp.pkg)
+                if opts.recurse:
+                    log(opts.logfile, "Error building %s, may try again" % os.path.basename(cp.pkg))
+                else:
+                    log(opts.logfile, "Error building %s" % os.path.basename(cp.pkg))
+                    log(opts.logfile, "See logs/results in %s" % opts.local_repo_dir)
+                    if not opts.cont:
+                        stop = True
+                        continue
+                for other in graph.failed(cp):
+                    log(opts.logfile, "Not building %s, it needs %s" % (
+                        os.path.basename(other.pkg), os.path.basename(cp.pkg)))
+                    failed.append(other.pkg)
+                    blocked[other.pkg] = cp.pkg
+            elif ret == 1:
+                log(opts.logfile, "Success building %s" % os.path.basename(cp.pkg))
+                built_pkgs.append(cp.pkg)
+                new_rpms.append(cp)
+            elif ret == 2:
+                log(opts.logfile, "Skipping already built pkg %s" % os.path.basename(cp.pkg))
+                graph.built(cp, built_provides(opts, cp.pkg))
+
+        if new_rpms:
+            # createrepo with the new pkgs
+            out, err = update_local_repo(opts)
+            if err.strip():
+                log(opts.logfile, "Error making local repo: %s" % opts.local_repo_dir)
+                log(opts.logfile, "Err: %s" % err)
+            # nothing waiting on these may start before they are in the repo
+            for cp in new_rpms:
+                graph.built(cp, built_provides(opts, cp.pkg))
+
+    for t in threads:
+        todo.put(None)
+    for t in threads:
+        t.join()
+    for session in mock_sessions.values():
+        session.close()
+    if stop:
+        sys.exit(1)
+    return failed, blocked
+
+
+# how often a pkg which timed out is tried again, each time with twice the
+# timeout of the try before
+max_timeout_retries = 2
+
+def build_pkgs(opts, cfg, pkgs, pkg_info, built_pkgs):
+    """build pkgs (already in build order), returns those not built. With
+       --recurse, the pkgs which failed are tried again in another round if
+       the reason they failed may have gone away"""
+    to_be_built = pkgs
+    timeout_retries = {}
+    given_up = []
+    while to_be_built:
+        built_before = len(built_pkgs)
+        failed, blocked = build_round(opts, cfg, to_be_built, pkg_info, built_pkgs)
+        if not opts.recurse or not failed:
+            return given_up + failed
+
+        progress = len(built_pkgs) > built_before
+        new_provides = set()
+        for pkg in built_pkgs[built_before:]:
+            new_provides.update(built_provides(opts, pkg))
+
+        retry = set()
+        for pkg in failed:
+            if pkg in blocked:
+                continue
+            s_pkg = os.path.basename(pkg)
+            reason, missing = classify_failure(pkg_resdir(opts, pkg),
+                                               opts.build_log_starts.get(pkg, 0))
+            if reason == 'buildreq':
+                if missing & new_provides or (not missing and progress):
+                    log(opts.logfile, "%s was missing %s, built now" % (s_pkg, " ".join(missing)))
+                    retry.add(pkg)
+                else:
+                    log(opts.logfile, "%s is missing %s, nothing built provides it" % (s_pkg, " ".join(missing)))
+            elif reason == 'timeout':
+                if opts.timeouts.get(pkg, opts.rpmbuild_timeout) is None:
+                    log(opts.logfile, "%s timed out, but the timeout is not known, use --rpmbuild_timeout" % s_pkg)
+                elif timeout_retries.get(pkg, 0) < max_timeout_retries:
+                    timeout_retries[pkg] = timeout_retries.get(pkg, 0) + 1
+                    opts.timeouts[pkg] = 2 * opts.timeouts.get(pkg, opts.rpmbuild_timeout)
+                    log(opts.logfile, "%s timed out, trying again with a timeout of %ds" % (s_pkg, opts.timeouts[pkg]))
+                    retry.add(pkg)
+                else:
+                    log(opts.logfile, "%s timed out %d times, giving up" % (s_pkg, max_timeout_retries + 1))
+            elif reason == 'build':
+                log(opts.logfile, "%s failed to build, not trying again" % s_pkg)
+            elif progress:
+                log(opts.logfile, "%s failed, trying again as other pkgs got built" % s_pkg)
+                retry.add(pkg)
+            else:
+                log(opts.logfile, "%s failed, nothing got built to try again for" % s_pkg)
+        # the pkgs which were waiting on another get another chance with it
+        for pkg in failed:
+            if blocked.get(pkg) in retry:
+                retry.add(pkg)
+
+        given_up.extend([pkg for pkg in failed if pkg not in retry])
+        if not retry:
+            return given_up
+        to_be_built = [pkg for pkg in to_be_built if pkg in retry]
+        log(opts.logfile, 'Trying to rebuild %s failed pkgs' % len(to_be_built))
+    return []
+
+
 config_opts = {}
 
 def main(args):
@@ -260,87 +1040,65 @@ def main(args):
         shutil.copyfile(pth, opts.config_path + '/' + fn)
 
 
+    # timeouts raised for pkgs which timed out before
+    opts.timeouts = {}
+    # {pkg: size of its build.log before its last build}
+    opts.build_log_starts = {}
+
+    # what has been built before, and how long it took
+    opts.config_hash = file_checksum(my_mock_config)
+    opts.ledger = BuildLedger(os.path.join(local_tmp_dir, 'mockchain.db'))
+
     # createrepo on it
-    out, err = createrepo(opts.local_repo_dir)
+    opts.repo_cache_dir = os.path.normpath(local_tmp_dir + '/createrepo-cache/' + cfg + '/')
+    out, err = createrepo(opts.local_repo_dir, opts.repo_cache_dir)
     if err.strip():
         log(opts.logfile, "Error making local repo: %s" % opts.local_repo_dir)
         log(opts.logfile, "Err: %s" % err)
         sys.exit(1)
-
-
-    download_dir = tempfile.mkdtemp()
+    # what the repodata has entries for, and the pkgs whose result dirs
+    # have been written to since, see update_local_repo()
+    opts.repo_rpms = set(glob.glob(opts.local_repo_dir + '/*/*.rpm'))
+    opts.repo_touched = set()
+
+
+    # the build order comes from the srpm headers, so all the remote srpms
+    # are needed up front. they are kept for the next run.
+    cache_dir = os.path.join(local_tmp_dir, 'srpm-cache')
+    urls = [pkg for pkg in pkgs if pkg.endswith('.rpm') and
+              (pkg.startswith('http://') or pkg.startswith('https://'))]
+    fetched = fetch_pkgs(opts, urls, cache_dir)
     downloaded_pkgs = {}
     built_pkgs = []
-    try_again = True
-    to_be_built = pkgs
-    while try_again:
-        failed = []
-        for pkg in to_be_built:
-            if not pkg.endswith('.rpm'):
-                log(opts.logfile, "%s doesn't appear to be an rpm - skipping" % pkg)
-                failed.append(pkg)
+    failed = []
+    to_be_built = []
+    for pkg in pkgs:
+        if not pkg.endswith('.rpm'):
+            log(opts.logfile, "%s doesn't appear to be an rpm - skipping" % pkg)
+            failed.append(pkg)
+            continue
+        elif pkg in fetched:
+            url = pkg
+            pkg = fetched[url]
+            if pkg is None:
+                failed.append(url)
                 continue
-
-            elif pkg.startswith('http://') or pkg.startswith('https://'):
-                url = pkg
-                cwd = os.getcwd()
-                os.chdir(download_dir)
-                try:
-                    log(opts.logfile, 'Fetching %s' % url)
-                    ug = grabber.URLGrabber()
-                    fn = ug.urlgrab(url)
-                    pkg = download_dir + '/' + fn
-                except Exception, e:
-                    log(opts.logfile, 'Error Downloading %s: %s' % (url, str(e)))
-                    failed.append(url)
-                    os.chdir(cwd)
-                    continue
-                else:
-                    os.chdir(cwd)
-                    downloaded_pkgs[pkg] = url
-            log(opts.logfile, "Start build: %s" % pkg)
-            ret, cmd, out, err = do_build(opts, cfg, pkg)
-            log(opts.logfile, "End build: %s" % pkg)
-            if ret == 0:
-                if opts.recurse:
-                    failed.append(pkg)
-                    log(opts.logfile, "Error building %s, will try again" % os.path.basename(pkg))
-                else:
-                    log(opts.logfile,"Error building %s" % os.path.basename(pkg))
-                    log(opts.logfile,"See logs/results in %s" % opts.local_repo_dir)
-                    if not opts.cont:
-                        sys.exit(1)
-
-            elif ret == 1:
-                log(opts.logfile, "Success building %s" % os.path.basename(pkg))
-                built_pkgs.append(pkg)
-                # createrepo with the new pkgs
-                out, err = createrepo(opts.local_repo_dir)
-                if err.strip():
-                    log(opts.logfile, "Error making local repo: %s" % opts.local_repo_dir)
-                    log(opts.logfile, "Err: %s" % err)
-            elif ret == 2:
-                log(opts.logfile, "Skipping already built pkg %s" % os.path.basename(pkg))
-
-        if failed:
-            if len(failed) != len(to_be_built):
-                to_be_built = failed
-                try_again = True
-                log(opts.logfile, 'Trying to rebuild %s failed pkgs' % len(failed))
-            else:
-                log(opts.logfile, "Tried twice - following pkgs could not be successfully built:")
-                for pkg in failed:
-                    msg = pkg
-                    if pkg in downloaded_pkgs:
-                        msg = downloaded_pkgs[pkg]
-                    log(opts.logfile, msg)
-
-                try_again = False
-        else:
-            try_again = False
-
-    # cleaning up our download dir
-    shutil.rmtree(download_dir, ignore_errors=True)
+            downloaded_pkgs[pkg] = url
+        to_be_built.append(pkg)
+
+    # read all the srpm headers up front to work out the build order
+    pkg_info = read_pkg_info(opts, to_be_built)
+    failed.extend([pkg for pkg in to_be_built if pkg not in pkg_info])
+    to_be_built = [pkg for pkg in to_be_built if pkg in pkg_info]
+    to_be_built = order_pkgs(opts, to_be_built, pkg_info)
+
+    failed.extend(build_pkgs(opts, cfg, to_be_built, pkg_info, built_pkgs))
+    if failed:
+        log(opts.logfile, "The following pkgs could not be successfully built:")
+        for pkg in failed:
+            log(opts.logfile, downloaded_pkgs.get(pkg, pkg))
+
+    opts.ledger.close()
 
     log(opts.logfile, "Results out to: %s" % opts.local_repo_dir)
     log(opts.logfile, "Pkgs built: %s" % len(built_pkgs))
@@ -0,0 +1,303 @@
+#!/usr/bin/python -tt
+#
+# Script to measure the cost of some of the things mock does, so changes to
+# them can be compared on the same machine and the same data.
+#
+#   mock-bench.py rootcache [--codec=PROG ...] CHROOT_DIR
+#       pack and unpack CHROOT_DIR (e.g. /var/lib/mock/fedora-19-x86_64/root)
+#       like the root_cache plugin does, once per compress program, and
+#       report the times and the size of the cache. Run it as root so all
+#       of the buildroot can be read and unpacked with the right owners.
+#
+#   mock-bench.py do [--count=N] [--command=CMD]
+#       run a trivial command (/bin/true) N times (1000) through
+#       mockbuild.util.do() like mock runs everything, and report the wall
+#       clock and the CPU time mock itself used per command.
+#
+#   mock-bench.py buildlog [--size=MiB] [BUILD_LOG]
+#       replay BUILD_LOG (or made up lines, 200 MiB of them) through
+#       mockbuild.util.do() into a log file, the way rpmbuild's output goes
+#       to build.log, with a plain logging.FileHandler and with the
+#       BufferedFileHandler mock uses, and report the throughput of both.
+#
+#   mock-bench.py trace [--count=N]
+#       call Root.makeChrootPath() and a function taking config_opts N
+#       times (100000) undecorated, which is how mock runs them without
+#       --trace, wrapped by traceLog() with the trace logger off and on,
+#       and wrapped by the traceLog() of mock 1.1.35, which made the ENTER
+#       message up front, as a baseline, and report the time per call.
+#
+
+import os
+import os.path
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+# same as the default root_cache exclude_dirs
+exclude_dirs = ["./proc", "./sys", "./dev", "./tmp/ccache", "./var/cache/yum"]
+
+default_codecs = ["gzip", "pigz", "zstd -T0", ""]
+
+# use the mockbuild next to this script when run from a checkout
+pydir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "py")
+if os.path.isdir(os.path.join(pydir, "mockbuild")):
+    sys.path.insert(0, pydir)
+
+def run(cmd, cwd=None):
+    start = time.time()
+    ret = subprocess.call(cmd, cwd=cwd)
+    if ret != 0:
+        raise RuntimeError("command failed (%d): %s" % (ret, " ".join(cmd)))
+    return time.time() - start
+
+def have_program(codec):
+    prog = codec.split()[0]
+    for d in os.environ.get("PATH", "/usr/bin").split(os.pathsep):
+        if os.access(os.path.join(d, prog), os.X_OK):
+            return True
+    return False
+
+def bench_rootcache(args):
+    parser = OptionParser(usage="%prog rootcache [--codec=PROG ...] CHROOT_DIR")
+    parser.add_option("--codec", action="append", dest="codecs", default=[],
+            help="compress program to measure, like the root_cache"
+                 " compress_program option; can be given several times,"
+                 " '' means no compression. Default: gzip, pigz, zstd -T0"
+                 " and none")
+    parser.add_option("--tmpdir", default=None,
+            help="where to put the cache files and the unpacked trees;"
+                 " should be on the same filesystem as the real cache")
+    (opts, args) = parser.parse_args(args)
+    if len(args) != 1 or not os.path.isdir(args[0]):
+        parser.error("need the chroot dir to pack")
+    chroot = args[0]
+    codecs = opts.codecs or default_codecs
+
+    workdir = tempfile.mkdtemp(prefix="mock-bench-", dir=opts.tmpdir)
+    try:
+        print "%-12s %10s %10s %12s" % ("codec", "pack(s)", "unpack(s)", "size(MiB)")
+        for codec in codecs:
+            if codec and not have_program(codec):
+                print "%-12s not installed, skipped" % codec
+                continue
+            cache = os.path.join(workdir, "cache.tar")
+            compress = []
+            if codec:
+                compress = ["--use-compress-program", codec]
+            pack = run(["tar", "--one-file-system"] + compress + ["-cf", cache]
+                       + ["--exclude=" + d for d in exclude_dirs] + ["."], cwd=chroot)
+            size = os.path.getsize(cache)
+            unpacked = os.path.join(workdir, "root")
+            os.mkdir(unpacked)
+            unpack = run(["tar"] + compress + ["-xf", cache], cwd=unpacked)
+            print "%-12s %10.2f %10.2f %12.1f" % (codec or "none", pack, unpack, size / 1048576.0)
+            sys.stdout.flush()
+            shutil.rmtree(unpacked)
+            os.unlink(cache)
+    finally:
+        shutil.rmtree(workdir)
+    return 0
+
+def bench_do(args):
+    parser = OptionParser(usage="%prog do [--count=N] [--command=CMD]")
+    parser.add_option("--count", type="int", default=1000,
+            help="how many times to run the command, default 1000")
+    parser.add_option("--command", default="/bin/true",
+            help="the command to run, through the shell; default /bin/true")
+    (opts, args) = parser.parse_args(args)
+    if args:
+        parser.error("no arguments expected")
+
+    import logging
+    import mockbuild.util
+    # mock logs every command at debug level, like that to a file
+    log = logging.getLogger("mock-bench")
+    log.propagate = False
+    log.setLevel(logging.DEBUG)
+    log.addHandler(logging.FileHandler("/dev/null"))
+
+    before = os.times()
+    start = time.time()
+    for i in xrange(opts.count):
+        mockbuild.util.do(opts.command, shell=True, logger=log)
+    wall = time.time() - start
+    after = os.times()
+    cpu = (after[0] - before[0]) + (after[1] - before[1])
+    print "%d x %s" % (opts.count, opts.command)
+    print "wall:     %8.3fs  %8.3fms per command" % (wall, wall * 1000 / opts.count)
+    print "mock cpu: %8.3fs  %8.3fms per command" % (cpu, cpu * 1000 / opts.count)
+    return 0
+
+def bench_buildlog(args):
+    parser = OptionParser(usage="%prog buildlog [--size=MiB] [BUILD_LOG]")
+    parser.add_option("--size", type="int", default=200,
+            help="MiB of made up build log lines to use when no BUILD_LOG"
+                 " is given, default 200")
+    parser.add_option("--tmpdir", default=None,
+            help="where to put the log files")
+    (opts, args) = parser.parse_args(args)
+    if len(args) > 1 or (args and not os.path.isfile(args[0])):
+        parser.error("need at most one build log to replay")
+
+    import logging
+    import mockbuild.util
+    workdir = tempfile.mkdtemp(prefix="mock-bench-", dir=opts.tmpdir)
+    try:
+        if args:
+            replay = args[0]
+        else:
+            replay = os.path.join(workdir, "replay.log")
+            f = open(replay, "w")
+            line = "gcc -O2 -g -pipe -Wall -fexceptions -c -o foo.o foo.c -I../include\n"
+            f.write(line * (opts.size * 1048576 / len(line)))
+            f.close()
+        size = os.path.getsize(replay) / 1048576.0
+
+        print "%-10s %10s %10s" % ("handler", "time(s)", "MiB/s")
+        for (name, handlerClass) in (("plain", logging.FileHandler),
+                                     ("buffered", mockbuild.util.BufferedFileHandler)):
+            logfile = os.path.join(workdir, "build.log")
+            log = logging.getLogger("mock-bench.%s" % name)
+            log.propagate = False
+            log.setLevel(logging.DEBUG)
+            handler = handlerClass(logfile, "a+")
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            log.addHandler(handler)
+            try:
+                start = time.time()
+                mockbuild.util.do(["cat", replay], logger=log)
+                mockbuild.util.flushLogs(log)
+                elapsed = time.time() - start
+            finally:
+                log.removeHandler(handler)
+                handler.close()
+                os.unlink(logfile)
+            print "%-10s %10.2f %10.1f" % (name, elapsed, size / elapsed)
+            sys.stdout.flush()
+    finally:
+        shutil.rmtree(workdir)
+    return 0
+
+class TraceBenchRoot(object):
+    """stands in for mockbuild.backend.Root, which needs a whole config;
+       its makeChrootPath() is the one of Root"""
+    def __init__(self, config_opts):
+        self._rootdir = os.path.join(config_opts['basedir'], "bench", "root")
+        self.config_opts = config_opts
+
+    def getConfigOpt(self, config_opts, key):
+        return config_opts[key]
+
+def eagerTraceLog(log=None):
+    """traceLog() as it was before it made the ENTER message lazily: the
+       repr of every argument is taken on each call, logged or not"""
+    import logging
+    from peak.util.decorators import rewrap
+    from mockbuild.trace_decorator import doLog
+    def decorator(func):
+        def trace(*args, **kw):
+            filename = os.path.normcase(func.func_code.co_filename)
+            func_name = func.func_code.co_name
+            lineno = func.func_code.co_firstlineno
+
+            l2 = kw.get('logger', log)
+            if l2 is None:
+                l2 = logging.getLogger("trace.%s" % func.__module__)
+            if isinstance(l2, basestring):
+                l2 = logging.getLogger(l2)
+
+            message = "ENTER %s(" % func_name
+            for arg in args:
+                message = message + repr(arg) + ", "
+            for k,v in kw.items():
+                message = message + "%s=%s" % (k,repr(v))
+            message = message + ")"
+
+            frame = sys._getframe(2)
+            doLog(l2, logging.INFO, os.path.normcase(frame.f_code.co_filename), frame.f_lineno, message, args=[], exc_info=None, func=frame.f_code.co_name)
+            try:
+                result = "Bad exception raised: Exception was not a derived class of 'Exception'"
+                try:
+                    result = func(*args, **kw)
+                except (KeyboardInterrupt, Exception), e:
+                    result = "EXCEPTION RAISED"
+                    doLog(l2, logging.INFO, filename, lineno, "EXCEPTION: %s\n" % e, args=[], exc_info=sys.exc_info(), func=func_name)
+                    raise
+            finally:
+                doLog(l2, logging.INFO, filename, lineno, "LEAVE %s --> %s\n" % (func_name, result), args=[], exc_info=None, func=func_name)
+
+            return result
+        return rewrap(func, trace)
+    return decorator
+
+def bench_trace(args):
+    parser = OptionParser(usage="%prog trace [--count=N]")
+    parser.add_option("--count", type="int", default=100000,
+            help="how many calls to time, default 100000")
+    (opts, args) = parser.parse_args(args)
+    if args:
+        parser.error("no arguments expected")
+
+    import logging
+    import mockbuild.trace_decorator
+    # without --trace mock leaves the methods of Root undecorated
+    mockbuild.trace_decorator.tracing = False
+    import mockbuild.backend
+    import mockbuild.util
+    makeChrootPath = mockbuild.backend.Root.makeChrootPath.im_func
+    getConfigOpt = TraceBenchRoot.getConfigOpt.im_func
+    config_opts = mockbuild.util.setup_default_config_opts(os.getgid(), "bench", "")
+    root = TraceBenchRoot(config_opts)
+    # like mock: the handlers are on the root logger, and --trace lets the
+    # trace logger pass records on to them
+    logging.getLogger().addHandler(logging.FileHandler("/dev/null"))
+    logging.getLogger().setLevel(logging.NOTSET)
+    logging.raiseExceptions = 0
+    trace = logging.getLogger("trace")
+
+    def timeit(func, *args):
+        start = time.time()
+        for i in xrange(opts.count):
+            func(*args)
+        return (time.time() - start) * 1000000 / opts.count
+
+    def traceLog():
+        mockbuild.trace_decorator.tracing = True
+        return mockbuild.trace_decorator.traceLog()
+
+    print "%-28s %16s %16s" % ("", "makeChrootPath", "config_opts arg")
+    for (name, decorator, propagate) in (("undecorated (no --trace)", None, 0),
+                                         ("old eager, logger off", eagerTraceLog, 0),
+                                         ("traced, logger off", traceLog, 0),
+                                         ("old eager, logged", eagerTraceLog, 1),
+                                         ("traced, logged", traceLog, 1)):
+        trace.propagate = propagate
+        funcs = (makeChrootPath, getConfigOpt)
+        if decorator is not None:
+            funcs = [decorator()(func) for func in funcs]
+        print "%-28s %13.2fus %13.2fus" % (name,
+            timeit(funcs[0], root, "builddir", "build"),
+            timeit(funcs[1], root, config_opts, "basedir"))
+        sys.stdout.flush()
+    return 0
+
+benchmarks = {
+    "buildlog": bench_buildlog,
+    "do": bench_do,
+    "rootcache": bench_rootcache,
+    "trace": bench_trace,
+}
+
+def main(argv):
+    if len(argv) < 2 or argv[1] not in benchmarks:
+        print >>sys.stderr, "usage: %s {%s} [options]" % (
+            os.path.basename(argv[0]), "|".join(sorted(benchmarks.keys())))
+        return 2
+    return benchmarks[argv[1]](argv[2:])
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
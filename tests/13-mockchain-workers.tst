@@ -0,0 +1,54 @@
+#!/bin/sh
+
+. ${TESTDIR}/functions
+
+#
+# test-A buildrequires test-B, which buildrequires test-C: even with three
+# workers each may only start once the one it needs is in the local repo
+#
+header "test mockchain parallel workers"
+localrepo=$(mktemp -d)
+runcmd "$MOCKCHAIN --workers 3 -l $localrepo --log=mockchain.log ${TESTDIR}/*.src.rpm"
+res=$?
+
+if [ $res -ne 0 ]; then
+   echo "mockchain returned fail when should have succeeded!"
+   sudo rm -rf $localrepo
+   exit 1
+fi
+
+fails=0
+repo=$localrepo/results/$testConfig
+for pkg in test-A-1.1-0 test-B-1.1-0 test-C-1.1-0; do
+    if ! ls $repo/$pkg/ 2>/dev/null | grep -v '\.src\.rpm$' | grep -q '\.rpm$'; then
+        echo "no rpms of $pkg in the local repo!"
+        fails=$(($fails+1))
+    fi
+done
+for name in test-A test-B test-C; do
+    if ! zgrep -q "<name>$name</name>" $repo/repodata/*primary.xml.gz; then
+        echo "$name is not in the local repo metadata!"
+        fails=$(($fails+1))
+    fi
+done
+
+# the line of the log saying pkg $1 was built comes before the one saying
+# pkg $2 was started
+line() {
+    grep -n "$1" $localrepo/mockchain.log | head -1 | cut -d: -f1
+}
+for pair in "C B" "B A"; do
+    set -- $pair
+    built=$(line "Success building test-$1-")
+    started=$(line "Start build: .*test-$2-")
+    if [ -z "$built" ] || [ -z "$started" ] || [ $built -gt $started ]; then
+        echo "test-$2 was started before test-$1 was built!"
+        fails=$(($fails+1))
+    fi
+done
+
+sudo rm -rf $localrepo
+if [ $fails -ne 0 ]; then
+    exit 1
+fi
+exit 0
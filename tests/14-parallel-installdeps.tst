@@ -0,0 +1,83 @@
+#!/bin/sh
+
+. ${TESTDIR}/functions
+
+#
+# Several mocks of one config installing build deps at the same time. They
+# only read the yum cache (--offline), so they should not wait for each
+# other on its lock: the same installdeps are run one after the other and
+# then all at once, the times reported, and what got installed compared.
+#
+header "test parallel installdeps on one config"
+N=${PARALLEL_INSTALLDEPS:-4}
+logdir=$(mktemp -d)
+
+mockp() {
+    i=$1
+    shift
+    $MOCKCMD --uniqueext=$uniqueext-p$i --resultdir=$outdir-p$i "$@"
+}
+
+initall() {
+    for i in $(seq 1 $N); do
+        runcmd "$MOCKCMD --uniqueext=$uniqueext-p$i --resultdir=$outdir-p$i --init" || exit 1
+    done
+}
+
+installdeps() {
+    mockp $1 --offline --installdeps $MOCKSRPM > $logdir/$1.log 2>&1
+    ret=$?
+    if [ $ret -ne 0 ]; then
+        echo "installdeps $1 failed:"
+        cat $logdir/$1.log
+    fi
+    return $ret
+}
+
+# the sorted list of pkgs installed in chroot $1, in $logdir/$2
+listrpms() {
+    mockp $1 --offline --chroot "rpm -qa | sort > /tmp/installdeps.rpms" > /dev/null 2>&1 &&
+        cp /var/lib/mock/${testConfig}-$uniqueext-p$1/root/tmp/installdeps.rpms $logdir/$2
+}
+
+# milliseconds since the epoch
+now() {
+    echo $(($(date +%s%N) / 1000000))
+}
+
+fails=0
+initall
+start=$(now)
+for i in $(seq 1 $N); do
+    installdeps $i || exit 1
+done
+serial=$(($(now) - $start))
+listrpms 1 serial.rpms || exit 1
+
+initall
+start=$(now)
+for i in $(seq 1 $N); do
+    ( installdeps $i; echo $? > $logdir/$i.ret ) &
+done
+wait
+parallel=$(($(now) - $start))
+
+for i in $(seq 1 $N); do
+    if [ "$(cat $logdir/$i.ret)" != "0" ]; then
+        echo "parallel installdeps $i failed!"
+        fails=$(($fails+1))
+    elif ! listrpms $i parallel-$i.rpms || ! cmp -s $logdir/serial.rpms $logdir/parallel-$i.rpms; then
+        echo "parallel installdeps $i did not install the same pkgs as the serial one:"
+        diff $logdir/serial.rpms $logdir/parallel-$i.rpms
+        fails=$(($fails+1))
+    fi
+    runcmd "$MOCKCMD --uniqueext=$uniqueext-p$i --resultdir=$outdir-p$i --clean"
+done
+rm -rf $logdir
+
+echo "$N installdeps: ${serial}ms one after the other, ${parallel}ms in parallel"
+echo "parallel took $(($parallel * 100 / $serial))% of the serial time"
+if [ $fails -ne 0 ]; then
+    exit 1
+fi
+exit 0
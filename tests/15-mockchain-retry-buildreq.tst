@@ -0,0 +1,69 @@
+#!/bin/sh
+
+. ${TESTDIR}/functions
+
+#
+# test-E buildrequires test-D-virt, which test-D provides through a macro.
+# mockchain does not expand the macros of specs, so it can not tell test-E
+# needs test-D and builds it first, as given. That fails on the missing
+# buildreq, and with --recurse test-E has to be tried again once test-D
+# is built.
+#
+header "test mockchain retrying a pkg missing a buildreq"
+workdir=$(mktemp -d)
+for pkg in D E; do
+    if [ $pkg = D ]; then
+        deps="Provides: test-D-virt%{?nil}"
+    else
+        deps="BuildRequires: test-D-virt"
+    fi
+    cat > $workdir/test-$pkg.spec <<SPEC
+Name: test-$pkg
+Version: 1.1
+Release: 0
+Summary: Test package for mockchain retrying builds
+License: GPL
+Group: System Environment/Base
+BuildArch: noarch
+$deps
+
+%description
+Test package for mockchain retrying builds
+
+%prep
+
+%build
+
+%install
+mkdir -p \$RPM_BUILD_ROOT/etc
+echo "%{name} is here" > \$RPM_BUILD_ROOT/etc/%{name}-installed
+
+%files
+/etc/%{name}-installed
+SPEC
+    rpmbuild -bs --define "_topdir $workdir" --define "_srcrpmdir $workdir" \
+        $workdir/test-$pkg.spec > /dev/null || exit 1
+done
+
+runcmd "$MOCKCHAIN --recurse -l $workdir/repo --log=mockchain.log $workdir/test-E-1.1-0.src.rpm $workdir/test-D-1.1-0.src.rpm"
+res=$?
+
+fails=0
+if [ $res -ne 0 ]; then
+   echo "mockchain returned fail when should have succeeded!"
+   fails=$(($fails+1))
+fi
+if ! grep -q "test-E-1.1-0.src.rpm was missing test-D-virt, built now" $workdir/repo/mockchain.log; then
+   echo "test-E was not tried again for its missing buildreq!"
+   fails=$(($fails+1))
+fi
+if ! ls $workdir/repo/results/$testConfig/test-E-1.1-0/ | grep -q 'noarch\.rpm$'; then
+   echo "test-E did not get built!"
+   fails=$(($fails+1))
+fi
+
+sudo rm -rf $workdir
+if [ $fails -ne 0 ]; then
+    exit 1
+fi
+exit 0